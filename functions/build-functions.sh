@@ -0,0 +1,16 @@
+#!/bin/bash
+set -eu
+
+# Generates the build artifacts the Lambda function sources need before taskcat packages them.
+# Needs credentials allowed to call ec2:DescribeRegions, ec2:DescribeInstanceTypes and ec2:DescribeInstanceTypeOfferings.
+# usage: build-functions.sh [--regions <region> ...]
+
+function main() {
+  local source_dir
+  source_dir="$(cd "$(dirname "$0")/source" && pwd)"
+
+  echo "Capturing the instance catalog snapshot of ComputeResourceSize"
+  (cd "${source_dir}/ComputeResourceSize" && python3 build_instance_catalog.py "$@")
+}
+
+main "$@"
@@ -0,0 +1,138 @@
+"""Latency, retry and throttle metrics of the AWS calls, logged in CloudWatch Embedded Metric Format.
+
+instrument() hooks the botocore events of a client, cfnruntime does it for every client it creates.
+flush() logs one EMF document per operation called since the previous flush, cfnruntime calls it
+once at the end of every invocation. Copied into every function folder like cfnresponse.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+NAMESPACE = 'UiPathAutomationSuite/CustomResources'
+DIMENSIONS = ['FunctionName', 'Service', 'Operation']
+# Upper bounds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# EMF metric value arrays hold at most 100 values, the latencies beyond are sampled
+MAX_LATENCY_VALUES = 100
+THROTTLING_ERRORS = ('SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+                     'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException')
+# Request context key of the operation model and start time of a call
+CALL_KEY = 'awsmetrics_call'
+
+_operations = {}
+_lock = threading.Lock()
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.latencies = []
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.max_latency = 0.0
+
+    def add_call(self, latency: float, retries: int, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.retries += retries
+        self.max_latency = max(self.max_latency, latency)
+        self.histogram[sum(latency > bound for bound in LATENCY_BUCKETS_MS)] += 1
+        # reservoir sample, every call has the same chance of being among the logged values
+        if len(self.latencies) < MAX_LATENCY_VALUES:
+            self.latencies.append(latency)
+        else:
+            position = random.randrange(self.calls)
+            if position < MAX_LATENCY_VALUES:
+                self.latencies[position] = latency
+
+
+def get_operation_stats(model) -> OperationStats:
+    key = (model.service_model.service_name, model.name)
+    if key not in _operations:
+        _operations[key] = OperationStats()
+    return _operations[key]
+
+
+def before_call(model, context, **kwargs):
+    context[CALL_KEY] = (model, time.monotonic())
+
+
+def record_call(context, failed: bool, retries: int = 0):
+    if CALL_KEY not in context:
+        return
+    model, started = context.pop(CALL_KEY)
+    latency = round((time.monotonic() - started) * 1000, 1)
+    with _lock:
+        get_operation_stats(model).add_call(latency, retries, failed)
+
+
+def after_call(context, parsed, **kwargs):
+    # error responses come here too, they are only raised after this event
+    record_call(context, 'Error' in parsed, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+
+def after_call_error(context, **kwargs):
+    # the call gave up on an exception, a connection error for instance
+    record_call(context, True)
+
+
+def needs_retry(response, operation, caught_exception=None, **kwargs):
+    # runs before the retry handler of the client for every attempt, the answer is left to that handler
+    if response is None:
+        return None
+    http_response, parsed = response
+    if http_response.status_code == 429 or parsed.get('Error', {}).get('Code') in THROTTLING_ERRORS:
+        with _lock:
+            get_operation_stats(operation).throttles += 1
+    return None
+
+
+def instrument(client):
+    events = client.meta.events
+    events.register('before-call', before_call)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call_error)
+    events.register_first('needs-retry', needs_retry)
+    return client
+
+
+def flush():
+    """Log the metrics of the operations called since the previous flush and start over."""
+    global _operations
+    with _lock:
+        operations, _operations = _operations, {}
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    for (service, operation), stats in sorted(operations.items()):
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [DIMENSIONS],
+                    'Metrics': [
+                        {'Name': 'Latency', 'Unit': 'Milliseconds'},
+                        {'Name': 'Calls', 'Unit': 'Count'},
+                        {'Name': 'Errors', 'Unit': 'Count'},
+                        {'Name': 'Retries', 'Unit': 'Count'},
+                        {'Name': 'Throttles', 'Unit': 'Count'}
+                    ]
+                }]
+            },
+            'FunctionName': function_name,
+            'Service': service,
+            'Operation': operation,
+            'Latency': stats.latencies,
+            'Calls': stats.calls,
+            'Errors': stats.errors,
+            'Retries': stats.retries,
+            'Throttles': stats.throttles,
+            'MaxLatency': stats.max_latency,
+            'LatencyHistogram': {
+                f'le{bound}ms' if bound else f'gt{LATENCY_BUCKETS_MS[-1]}ms': count
+                for bound, count in zip(LATENCY_BUCKETS_MS + (None,), stats.histogram)
+            }
+        }))
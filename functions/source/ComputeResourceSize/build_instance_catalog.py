@@ -0,0 +1,80 @@
+"""Capture the EC2 instance catalog of every region into the snapshot read by instance_catalog.py.
+
+Run before packaging the ComputeResourceSize function, with credentials allowed to call
+ec2:DescribeRegions, ec2:DescribeInstanceTypes and ec2:DescribeInstanceTypeOfferings:
+
+    python build_instance_catalog.py [--regions us-east-1 eu-west-1] [--output instance_catalog.json.gz]
+"""
+import argparse
+import datetime
+import gzip
+import json
+import boto3
+from instance_catalog import SNAPSHOT_COLUMNS, SNAPSHOT_FORMAT, SNAPSHOT_PATH, SNAPSHOT_VERSION, describe_to_row
+
+
+def list_regions() -> list:
+    ec2 = boto3.client('ec2')
+    regions = ec2.describe_regions(AllRegions=False)['Regions']
+    return sorted(region['RegionName'] for region in regions)
+
+
+def describe_region(region: str):
+    ec2 = boto3.client('ec2', region_name=region)
+    offered_types = set()
+    for page in ec2.get_paginator('describe_instance_type_offerings').paginate(LocationType='region'):
+        offered_types.update(offering['InstanceType'] for offering in page['InstanceTypeOfferings'])
+
+    descriptions = {}
+    for page in ec2.get_paginator('describe_instance_types').paginate(
+        Filters=[
+            {
+                'Name': 'supported-virtualization-type',
+                'Values': ['hvm']
+            }
+        ]
+    ):
+        for description in page['InstanceTypes']:
+            if description['InstanceType'] in offered_types:
+                descriptions[description['InstanceType']] = description
+    return descriptions
+
+
+def build_snapshot(regions: list) -> dict:
+    rows = {}
+    region_types = {}
+    for region in regions:
+        print(f"Describing instance types in {region}")
+        descriptions = describe_region(region)
+        region_types[region] = sorted(descriptions)
+        for instance_type, description in descriptions.items():
+            rows.setdefault(instance_type, describe_to_row(description))
+
+    type_names = sorted(rows)
+    positions = {name: position for position, name in enumerate(type_names)}
+    columns = {column: [rows[name][column_index] for name in type_names] for column_index, column in enumerate(SNAPSHOT_COLUMNS)}
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'generated_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'columns': columns,
+        'regions': {region: [positions[name] for name in names] for region, names in region_types.items()}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the offline EC2 instance catalog snapshot')
+    parser.add_argument('--regions', nargs='*', help='Regions to capture, defaults to every enabled region')
+    parser.add_argument('--output', default=SNAPSHOT_PATH, help='Snapshot file to write')
+    args = parser.parse_args()
+
+    snapshot = build_snapshot(args.regions or list_regions())
+    # A fixed gzip mtime keeps rebuilds from differing in the compressed header alone
+    with open(args.output, 'wb') as output_file, gzip.GzipFile(fileobj=output_file, mode='wb', mtime=0) as snapshot_file:
+        snapshot_file.write(json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+    print(f"Wrote {len(snapshot['columns']['instance_type'])} instance types for "
+          f"{len(snapshot['regions'])} regions to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
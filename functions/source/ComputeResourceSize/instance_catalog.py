@@ -0,0 +1,259 @@
+import gzip
+import json
+import os
+import time
+import cfnruntime
+
+# Instance type descriptions change rarely, so warm invocations can reuse them for a while
+CATALOG_TTL_SECONDS = 3600
+# describe_instance_types accepts at most 100 instance types per call
+DESCRIBE_INSTANCE_TYPES_BATCH = 100
+# Bounded per-call latency, the sizing Lambda only has a few seconds for its lookups
+EC2_CLIENT_CONFIG = {'connect_timeout': 5, 'read_timeout': 10, 'retries': {'max_attempts': 3, 'mode': 'standard'}}
+
+# Offline snapshot produced by build_instance_catalog.py, used before falling back to the EC2 API
+SNAPSHOT_PATH = os.environ.get(
+    'INSTANCE_CATALOG_SNAPSHOT',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance_catalog.json.gz')
+)
+SNAPSHOT_FORMAT = 'uipath-instance-catalog'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = [
+    'instance_type',
+    'vcpus',
+    'memory_mib',
+    'architectures',
+    'burstable',
+    'current_generation',
+    'gpu_manufacturer',
+    'gpu_name',
+    'gpu_count',
+    'gpu_memory_mib'
+]
+
+# region -> {'expires_at': float, 'requested': set, 'types': {instance_type: description}}
+_catalog_cache = {}
+# (region, zones, types) -> {'expires_at': float, 'types': set}
+_zone_offerings_cache = {}
+_snapshot = None
+
+
+def get_ec2_client(region: str):
+    return cfnruntime.get_client('ec2', region, **EC2_CLIENT_CONFIG)
+
+
+def describe_to_row(description: dict) -> list:
+    gpus = description.get('GpuInfo', {}).get('Gpus', [])
+    gpu = gpus[0] if gpus else {}
+    return [
+        description['InstanceType'],
+        description['VCpuInfo']['DefaultVCpus'],
+        description['MemoryInfo']['SizeInMiB'],
+        description.get('ProcessorInfo', {}).get('SupportedArchitectures', []),
+        description.get('BurstablePerformanceSupported', False),
+        description.get('CurrentGeneration', False),
+        gpu.get('Manufacturer', ''),
+        gpu.get('Name', ''),
+        sum(crt_gpu['Count'] for crt_gpu in gpus),
+        gpu.get('MemoryInfo', {}).get('SizeInMiB', 0)
+    ]
+
+
+def row_to_describe(row: dict) -> dict:
+    """Rebuild the subset of a describe_instance_types entry the sizing code reads."""
+    description = {
+        'InstanceType': row['instance_type'],
+        'VCpuInfo': {'DefaultVCpus': row['vcpus']},
+        'MemoryInfo': {'SizeInMiB': row['memory_mib']},
+        'ProcessorInfo': {'SupportedArchitectures': row['architectures']},
+        'BurstablePerformanceSupported': row['burstable'],
+        'CurrentGeneration': row['current_generation'],
+        'SupportedVirtualizationTypes': ['hvm']
+    }
+    if row['gpu_count']:
+        description['GpuInfo'] = {
+            'Gpus': [{
+                'Name': row['gpu_name'],
+                'Manufacturer': row['gpu_manufacturer'],
+                'Count': row['gpu_count'],
+                'MemoryInfo': {'SizeInMiB': row['gpu_memory_mib']}
+            }],
+            'TotalGpuMemoryInMiB': row['gpu_count'] * row['gpu_memory_mib']
+        }
+    return description
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH):
+    """Load the offline catalog snapshot once per container. Returns None when it is missing or unusable."""
+    global _snapshot
+    if _snapshot is not None:
+        return _snapshot or None
+    try:
+        with gzip.open(path, 'rb') as snapshot_file:
+            document = json.loads(snapshot_file.read())
+    except FileNotFoundError:
+        print(f"No instance catalog snapshot found at {path}")
+        _snapshot = {}
+        return None
+    if document.get('format') != SNAPSHOT_FORMAT or document.get('version') != SNAPSHOT_VERSION:
+        print(f"Ignoring instance catalog snapshot with unsupported format {document.get('format')} v{document.get('version')}")
+        _snapshot = {}
+        return None
+
+    columns = document['columns']
+    type_names = columns['instance_type']
+    _snapshot = {
+        'generated_at': document.get('generated_at'),
+        'columns': columns,
+        'index': {name: position for position, name in enumerate(type_names)},
+        'regions': {region: set(positions) for region, positions in document['regions'].items()}
+    }
+    print(f"Loaded instance catalog snapshot generated at {_snapshot['generated_at']} "
+          f"with {len(type_names)} types in {len(_snapshot['regions'])} regions")
+    return _snapshot
+
+
+def snapshot_instance_types(region: str, types_list: list):
+    """Resolve types_list from the offline snapshot.
+
+    Returns the descriptions of the types offered in region and the list of types the snapshot knows
+    nothing about, which have to be resolved through the EC2 API.
+    """
+    snapshot = load_snapshot()
+    if snapshot is None or region not in snapshot['regions']:
+        return {}, list(types_list)
+
+    offered = snapshot['regions'][region]
+    columns = snapshot['columns']
+    types = {}
+    unknown_types = []
+    for crt_type in types_list:
+        position = snapshot['index'].get(crt_type)
+        if position is None:
+            unknown_types.append(crt_type)
+        elif position in offered:
+            types[crt_type] = row_to_describe({column: columns[column][position] for column in SNAPSHOT_COLUMNS})
+    return types, unknown_types
+
+
+def load_offline_catalog(region: str, types_list: list, catalog_path: str = None) -> dict:
+    """Catalog for offline tools, from a JSON list of describe_instance_types entries or the snapshot."""
+    if catalog_path:
+        with open(catalog_path) as catalog_file:
+            return {instance_obj['InstanceType']: instance_obj for instance_obj in json.load(catalog_file)}
+    if load_snapshot() is None:
+        raise Exception("No instance catalog snapshot available, run functions/build-functions.sh or pass a catalog file")
+    catalog, _ = snapshot_instance_types(region, types_list)
+    return catalog
+
+
+def check_deadline(deadline):
+    if deadline is not None and time.monotonic() >= deadline:
+        raise Exception("Instance catalog lookup ran out of time")
+
+
+def fetch_instance_types(region: str, types_list: list, deadline=None) -> dict:
+    ec2 = get_ec2_client(region)
+    available_types = []
+    check_deadline(deadline)
+    paginator = ec2.get_paginator('describe_instance_type_offerings')
+    for page in paginator.paginate(
+        LocationType='region',
+        Filters=[
+            {
+                'Name': 'location',
+                'Values': [region]
+            },
+            {
+                'Name': 'instance-type',
+                'Values': types_list
+            }
+        ]
+    ):
+        check_deadline(deadline)
+        available_types.extend(crt_type['InstanceType'] for crt_type in page['InstanceTypeOfferings'])
+    print(f"{len(available_types)} instance types available in {region}")
+
+    types = {}
+    for start in range(0, len(available_types), DESCRIBE_INSTANCE_TYPES_BATCH):
+        check_deadline(deadline)
+        response = ec2.describe_instance_types(
+            InstanceTypes=available_types[start:start + DESCRIBE_INSTANCE_TYPES_BATCH],
+            Filters=[
+                {
+                    'Name': 'supported-virtualization-type',
+                    'Values': ['hvm']
+                }
+            ]
+        )
+        for crt_type in response['InstanceTypes']:
+            types[crt_type['InstanceType']] = crt_type
+    return types
+
+
+def get_instance_catalog(region: str, types_list: list, deadline=None) -> dict:
+    """Return the descriptions of the types in types_list that are offered in region, keyed by instance type.
+
+    The offline snapshot is consulted first and the EC2 API is only queried for types it does not
+    cover. The result is cached per region, so callers should request the union of all the types
+    they need up front and resolve every node role from the returned index.
+    No EC2 call is started once deadline, a time.monotonic() value, has passed.
+    """
+    now = time.monotonic()
+    entry = _catalog_cache.get(region)
+    if entry is None or entry['expires_at'] <= now:
+        entry = {'expires_at': now + CATALOG_TTL_SECONDS, 'requested': set(), 'types': {}}
+        _catalog_cache[region] = entry
+
+    missing_types = sorted(set(types_list) - entry['requested'])
+    if missing_types:
+        snapshot_types, unknown_types = snapshot_instance_types(region, missing_types)
+        entry['types'].update(snapshot_types)
+        if unknown_types:
+            print(f"Fetching instance catalog for {region}: {unknown_types}")
+            entry['types'].update(fetch_instance_types(region, unknown_types, deadline))
+        entry['requested'].update(missing_types)
+    else:
+        print(f"Using cached instance catalog for {region}")
+
+    return {crt_type: entry['types'][crt_type] for crt_type in types_list if crt_type in entry['types']}
+
+
+def get_subnet_zones(region: str, subnet_ids: list, deadline=None) -> list:
+    """Distinct availability zones of subnet_ids, sorted by name."""
+    check_deadline(deadline)
+    subnets = get_ec2_client(region).describe_subnets(SubnetIds=subnet_ids)['Subnets']
+    return sorted({subnet['AvailabilityZone'] for subnet in subnets})
+
+
+def get_types_offered_in_zones(region: str, zones: list, types_list: list, deadline=None) -> set:
+    """Types from types_list that are offered in every one of zones."""
+    key = (region, tuple(sorted(zones)), tuple(sorted(types_list)))
+    now = time.monotonic()
+    entry = _zone_offerings_cache.get(key)
+    if entry is not None and entry['expires_at'] > now:
+        return entry['types']
+
+    zone_types = {zone: set() for zone in zones}
+    check_deadline(deadline)
+    paginator = get_ec2_client(region).get_paginator('describe_instance_type_offerings')
+    for page in paginator.paginate(
+        LocationType='availability-zone',
+        Filters=[
+            {
+                'Name': 'location',
+                'Values': list(zones)
+            },
+            {
+                'Name': 'instance-type',
+                'Values': list(types_list)
+            }
+        ]
+    ):
+        check_deadline(deadline)
+        for offering in page['InstanceTypeOfferings']:
+            zone_types[offering['Location']].add(offering['InstanceType'])
+    types = set.intersection(*zone_types.values()) if zone_types else set()
+    print(f"Instance types offered in all of {zones}: {sorted(types)}")
+    _zone_offerings_cache[key] = {'expires_at': now + CATALOG_TTL_SECONDS, 'types': types}
+    return types
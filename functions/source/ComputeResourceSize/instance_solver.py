@@ -0,0 +1,233 @@
+import math
+
+# On-demand Linux hourly prices (USD, us-east-1). Only the relative order matters for the
+# selection, so the table does not have to track regional price differences.
+INSTANCE_HOURLY_PRICES = {
+    'c4.8xlarge': 1.591,
+    'c5.2xlarge': 0.34,
+    'c5.4xlarge': 0.68,
+    'c5.9xlarge': 1.53,
+    'c5.12xlarge': 2.04,
+    'c5.18xlarge': 3.06,
+    'c5a.2xlarge': 0.308,
+    'c5a.4xlarge': 0.616,
+    'c5a.8xlarge': 1.232,
+    'c5a.12xlarge': 1.848,
+    'c5a.16xlarge': 2.464,
+    'c6a.2xlarge': 0.306,
+    'c6a.4xlarge': 0.612,
+    'c6a.8xlarge': 1.224,
+    'c6a.12xlarge': 1.836,
+    'c6a.16xlarge': 2.448,
+    'c6i.2xlarge': 0.34,
+    'c6i.4xlarge': 0.68,
+    'c6i.8xlarge': 1.36,
+    'c6i.12xlarge': 2.04,
+    'c6i.16xlarge': 2.72,
+    'm4.4xlarge': 0.8,
+    'm5.2xlarge': 0.384,
+    'm5.4xlarge': 0.768,
+    'm5.8xlarge': 1.536,
+    'm5.12xlarge': 2.304,
+    'm5.16xlarge': 3.072,
+    'm5a.2xlarge': 0.344,
+    'm5a.4xlarge': 0.688,
+    'm5a.8xlarge': 1.376,
+    'm5a.12xlarge': 2.064,
+    'm5a.16xlarge': 2.752,
+    'm6a.2xlarge': 0.3456,
+    'm6a.4xlarge': 0.6912,
+    'm6a.8xlarge': 1.3824,
+    'm6a.12xlarge': 2.0736,
+    'm6a.16xlarge': 2.7648,
+    'm6i.2xlarge': 0.384,
+    'm6i.4xlarge': 0.768,
+    'm6i.8xlarge': 1.536,
+    'm6i.12xlarge': 2.304,
+    'm6i.16xlarge': 3.072,
+    'r5.2xlarge': 0.504,
+    'r5.4xlarge': 1.008,
+    'r5.8xlarge': 2.016,
+    'r5.12xlarge': 3.024,
+    'r6i.2xlarge': 0.504,
+    'r6i.4xlarge': 1.008,
+    'r6i.8xlarge': 2.016,
+    'r6i.12xlarge': 3.024
+}
+
+# Same pricing source as INSTANCE_HOURLY_PRICES, for the NVIDIA GPU types a GPU node may use
+GPU_INSTANCE_HOURLY_PRICES = {
+    'g4dn.2xlarge': 0.752,
+    'g4dn.4xlarge': 1.204,
+    'g4dn.8xlarge': 2.176,
+    'g4dn.12xlarge': 3.912,
+    'g4dn.16xlarge': 4.352,
+    'g5.2xlarge': 1.212,
+    'g5.4xlarge': 1.624,
+    'g5.8xlarge': 2.448,
+    'g5.12xlarge': 5.672,
+    'g5.16xlarge': 4.096,
+    'g5.24xlarge': 8.144,
+    'g5.48xlarge': 16.288,
+    'g6.2xlarge': 0.9776,
+    'g6.4xlarge': 1.3232,
+    'g6.8xlarge': 2.0144,
+    'g6.12xlarge': 4.6016,
+    'g6.16xlarge': 3.3968,
+    'g6.24xlarge': 6.6758,
+    'g6.48xlarge': 13.3504,
+    'p4d.24xlarge': 32.7726
+}
+
+# GPU model -> (CUDA compute capability, deep learning throughput per GPU relative to a V100).
+# install-gpu.sh installs the current cuda package of the NVIDIA RHEL 8 repository, whose drivers
+# only support Turing (T4) and newer GPUs, so the K80 (p2), M60 (g3) and V100 (p3) are left out.
+GPU_MODELS = {
+    'T4': (7.5, 0.35),
+    'A10G': (8.6, 0.65),
+    'L4': (8.9, 0.6),
+    'A100': (8.0, 2.5)
+}
+
+OBJECTIVES = ('cost', 'waste')
+ALTERNATIVES_COUNT = 3
+
+
+def is_eligible(instance_obj: dict) -> bool:
+    """General purpose cluster nodes: priced, x86_64, not burstable and without GPUs."""
+    return (
+        instance_obj['InstanceType'] in INSTANCE_HOURLY_PRICES
+        and 'x86_64' in instance_obj.get('ProcessorInfo', {}).get('SupportedArchitectures', ['x86_64'])
+        and not instance_obj.get('BurstablePerformanceSupported', False)
+        and 'GpuInfo' not in instance_obj
+    )
+
+
+def evaluate_instance(instance_obj: dict, total_cpu: float, total_ram: float, min_cpu_per_node: float,
+                      min_ram_per_node: float, min_node_count: int, max_node_count, zone_count: int = 1):
+    instance_cpu = instance_obj['VCpuInfo']['DefaultVCpus']
+    instance_ram = instance_obj['MemoryInfo']['SizeInMiB'] // 1024
+    if instance_cpu < min_cpu_per_node or instance_ram < min_ram_per_node:
+        return None
+    required_nodes = max(int(math.ceil(total_cpu / instance_cpu)), int(math.ceil(total_ram / instance_ram)))
+    if zone_count > 1:
+        # Balanced across zones, with the surviving zones alone covering the requirements
+        nodes_per_zone = max(int(math.ceil(required_nodes / (zone_count - 1))), int(math.ceil(min_node_count / zone_count)))
+        node_count = nodes_per_zone * zone_count
+    else:
+        nodes_per_zone = None
+        node_count = max(required_nodes, min_node_count)
+    if max_node_count is not None and node_count > max_node_count:
+        return None
+    cluster_cpu = node_count * instance_cpu
+    cluster_ram = node_count * instance_ram
+    return {
+        'instance_type': instance_obj['InstanceType'],
+        'node_count': node_count,
+        'nodes_per_zone': nodes_per_zone,
+        'instance_cpu': instance_cpu,
+        'instance_ram': instance_ram,
+        'hourly_cost': round(node_count * INSTANCE_HOURLY_PRICES[instance_obj['InstanceType']], 4),
+        'stranded_cpu': round(cluster_cpu - total_cpu, 2),
+        'stranded_ram': round(cluster_ram - total_ram, 2),
+        # share of the provisioned capacity that no service asked for
+        'waste': round((cluster_cpu - total_cpu) / cluster_cpu + (cluster_ram - total_ram) / cluster_ram, 4)
+    }
+
+
+def solve_instance_plan(catalog: dict, total_cpu: float, total_ram: float, min_cpu_per_node: float,
+                        min_ram_per_node: float, min_node_count: int = 1, max_node_count=None,
+                        objective: str = 'cost', zone_count: int = 1) -> dict:
+    """Pick the instance type and node count covering total_cpu/total_ram at the lowest cost (or waste).
+
+    Every eligible type in catalog is considered. With zone_count > 1 the nodes are spread evenly
+    over the zones and sized so that losing any single zone still covers the requirements.
+    Ties are broken by the other metric and then by the smaller node count. Returns the best plan
+    with the runner-up plans under 'alternatives'.
+    """
+    if objective not in OBJECTIVES:
+        raise Exception(f"Unknown sizing objective {objective}")
+    plans = []
+    for instance_obj in catalog.values():
+        if not is_eligible(instance_obj):
+            continue
+        plan = evaluate_instance(instance_obj, total_cpu, total_ram, min_cpu_per_node, min_ram_per_node,
+                                 min_node_count, max_node_count, zone_count)
+        if plan:
+            plans.append(plan)
+    if not plans:
+        raise Exception("Minimum Instance HW requirements are not met")
+
+    if objective == 'cost':
+        plans.sort(key=lambda plan: (plan['hourly_cost'], plan['waste'], plan['node_count'], plan['instance_type']))
+    else:
+        plans.sort(key=lambda plan: (plan['waste'], plan['hourly_cost'], plan['node_count'], plan['instance_type']))
+    best_plan = dict(plans[0])
+    best_plan['alternatives'] = plans[1:ALTERNATIVES_COUNT + 1]
+    print(f"Selected {best_plan['node_count']} x {best_plan['instance_type']} at {best_plan['hourly_cost']}/h, "
+          f"alternatives: {[(plan['node_count'], plan['instance_type'], plan['hourly_cost']) for plan in best_plan['alternatives']]}")
+    return best_plan
+
+
+def evaluate_gpu_instance(instance_obj: dict, min_cpu_per_node: float, min_ram_per_node: float,
+                          min_gpu_memory: float, min_gpu_count: int):
+    """Score a GPU node shape, None when it does not meet the per node requirements.
+
+    min_gpu_memory is the GPU memory, in GiB, every single GPU must have.
+    """
+    gpus = instance_obj.get('GpuInfo', {}).get('Gpus', [])
+    if (
+        instance_obj['InstanceType'] not in GPU_INSTANCE_HOURLY_PRICES
+        or not gpus
+        or 'x86_64' not in instance_obj.get('ProcessorInfo', {}).get('SupportedArchitectures', ['x86_64'])
+    ):
+        return None
+    gpu = gpus[0]
+    if gpu.get('Manufacturer') != 'NVIDIA' or gpu.get('Name') not in GPU_MODELS:
+        print(f"Skipping {instance_obj['InstanceType']} with unsupported GPU {gpu.get('Manufacturer')} {gpu.get('Name')}")
+        return None
+    instance_cpu = instance_obj['VCpuInfo']['DefaultVCpus']
+    instance_ram = instance_obj['MemoryInfo']['SizeInMiB'] // 1024
+    gpu_count = sum(crt_gpu['Count'] for crt_gpu in gpus)
+    gpu_memory = gpu['MemoryInfo']['SizeInMiB'] // 1024
+    if (instance_cpu < min_cpu_per_node or instance_ram < min_ram_per_node
+            or gpu_memory < min_gpu_memory or gpu_count < min_gpu_count):
+        return None
+
+    compute_capability, gpu_throughput = GPU_MODELS[gpu['Name']]
+    hourly_price = GPU_INSTANCE_HOURLY_PRICES[instance_obj['InstanceType']]
+    return {
+        'instance_type': instance_obj['InstanceType'],
+        'gpu_name': gpu['Name'],
+        'gpu_count': gpu_count,
+        'total_gpu_memory': gpu_count * gpu_memory,
+        'compute_capability': compute_capability,
+        'hourly_cost': hourly_price,
+        'price_per_throughput': round(hourly_price / (gpu_count * gpu_throughput), 4)
+    }
+
+
+def solve_gpu_plan(catalog: dict, min_cpu_per_node: float, min_ram_per_node: float,
+                   min_gpu_memory: float, min_gpu_count: int = 1) -> dict:
+    """Pick the instance type of the GPU node.
+
+    Every NVIDIA GPU type in catalog is scored. Shapes with the fewest GPUs meeting min_gpu_count
+    come first, so extra GPUs are only bought when asked for, then the lowest price per unit of
+    throughput wins, with ties going to the newer GPU generation and the larger total GPU memory.
+    """
+    plans = []
+    for instance_obj in catalog.values():
+        plan = evaluate_gpu_instance(instance_obj, min_cpu_per_node, min_ram_per_node, min_gpu_memory, min_gpu_count)
+        if plan:
+            plans.append(plan)
+    if not plans:
+        raise Exception("Minimum Instance HW requirements are not met")
+
+    plans.sort(key=lambda plan: (plan['gpu_count'], plan['price_per_throughput'], -plan['compute_capability'],
+                                 -plan['total_gpu_memory'], plan['instance_type']))
+    best_plan = dict(plans[0])
+    best_plan['alternatives'] = plans[1:ALTERNATIVES_COUNT + 1]
+    print(f"Selected {best_plan['instance_type']} ({best_plan['gpu_count']} x "
+          f"{best_plan['gpu_name']}) at {best_plan['hourly_cost']}/h, alternatives: "
+          f"{[(plan['instance_type'], plan['price_per_throughput']) for plan in best_plan['alternatives']]}")
+    return best_plan
@@ -1,8 +1,71 @@
-import boto3
+import cfnruntime
+import base64
+import hashlib
 import json
 import cfnresponse
-import threading
+import time
 import math
+import zlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from instance_catalog import get_instance_catalog, get_subnet_zones, get_types_offered_in_zones
+from instance_solver import (
+    GPU_INSTANCE_HOURLY_PRICES, INSTANCE_HOURLY_PRICES, evaluate_instance, solve_gpu_plan, solve_instance_plan
+)
+
+# Baseline cluster footprint, on top of which the enabled services are added
+BASE_REQUIREMENTS = {
+    "single_node": {
+        'cpu': 9.5,
+        'ram': 16.4
+    },
+    "multi_node": {
+        'cpu': 40.0,
+        'ram': 47.6
+    }
+}
+# Add a 20% procent buffer for the selection
+RESOURCE_BUFFER = 1.2
+MIN_CPU_PER_NODE = 8
+MIN_RAM_PER_NODE = 16
+MIN_MULTI_NODE_COUNT = 3
+# Zone resilience needs enough zones for a single zone outage to leave a quorum behind
+MIN_RESILIENT_ZONE_COUNT = 3
+# Peak load the agents may scale out to, relative to the buffered requirements
+AUTOSCALING_MAX_FACTOR = 1.5
+MIN_TARGET_UTILIZATION = 40
+MAX_TARGET_UTILIZATION = 80
+
+MAX_LOOKUP_WORKERS = 4
+# Stop waiting for lookups early enough to report the failure before the timeout guard fires
+DEADLINE_MARGIN_SECONDS = 2.0
+
+# Properties that change the sizing result; an update touching none of them reuses the previous result
+SIZING_PROPERTIES = [
+    'RegionName',
+    'MultiNode',
+    'AddGpu',
+    'SizingObjective',
+    'Orchestrator',
+    'ActionCenter',
+    'AutomationHub',
+    'AutomationOps',
+    'Insights',
+    'DataService',
+    'TestManager',
+    'AiCenter',
+    'BusinessApps',
+    'DocumentUnderstanding',
+    'TaskMining',
+    'ProcessMining',
+    'ASRobots',
+    'PrivateSubnetIDs'
+]
+PHYSICAL_ID_PREFIX = 'sizing'
+PHYSICAL_ID_HASH_LENGTH = 16
+MAX_PHYSICAL_ID_LENGTH = 1024
+# Part of the sizing hash, bump it whenever the returned attributes or the sizing rules change so
+# the first update after an upgrade recomputes the attributes instead of returning the stored ones
+SIZING_SCHEMA_VERSION = 2
 
 # Platform is counted in the default value callculations
 SERVICES_REQUIRMENTS_MAP = {
@@ -124,6 +187,99 @@ SERVICES_REQUIRMENTS_MAP = {
     }
 }
 
+# Server node disks, all gp3. Platform is counted in the base values
+BASE_STORAGE = {
+    'data_disk': 512,
+    'etcd_disk': 16,
+    'cluster_disk': 256,
+    'iops': 3000,
+    'throughput': 125
+}
+# Per enabled service: data disk GB, data disk IOPS and data disk MB/s
+SERVICES_STORAGE_MAP = {
+    'platform': {
+        'disk': 0,
+        'iops': 0,
+        'throughput': 0
+    },
+    'action_center': {
+        'disk': 16,
+        'iops': 200,
+        'throughput': 10
+    },
+    'aicenter': {
+        'disk': 256,
+        'iops': 1500,
+        'throughput': 100
+    },
+    'apps': {
+        'disk': 32,
+        'iops': 500,
+        'throughput': 25
+    },
+    'automation_hub': {
+        'disk': 16,
+        'iops': 200,
+        'throughput': 10
+    },
+    'automation_ops': {
+        'disk': 8,
+        'iops': 100,
+        'throughput': 5
+    },
+    'asrobots': {
+        'disk': 64,
+        'iops': 500,
+        'throughput': 25
+    },
+    'dataservice': {
+        'disk': 32,
+        'iops': 300,
+        'throughput': 15
+    },
+    'documentunderstanding': {
+        'disk': 128,
+        'iops': 1500,
+        'throughput': 75
+    },
+    'insights': {
+        'disk': 64,
+        'iops': 500,
+        'throughput': 25
+    },
+    'orchestrator': {
+        'disk': 32,
+        'iops': 500,
+        'throughput': 25
+    },
+    'processmining': {
+        'disk': 512,
+        'iops': 3000,
+        'throughput': 250
+    },
+    'task_mining': {
+        'disk': 64,
+        'iops': 500,
+        'throughput': 25
+    },
+    'test_manager': {
+        'disk': 32,
+        'iops': 200,
+        'throughput': 10
+    }
+}
+# etcd load grows with the number of objects each enabled service adds to the cluster
+ETCD_IOPS_PER_SERVICE = 200
+DISK_SIZE_GRANULARITY = 64
+GP3_MAX_IOPS = 16000
+GP3_MAX_THROUGHPUT = 1000
+GP3_MAX_IOPS_PER_GB = 500
+GP3_MAX_THROUGHPUT_PER_IOPS = 0.25
+
+
+# Every node role is resolved from a single catalog fetch covering all candidates
+ALL_NODE_TYPES = list(INSTANCE_HOURLY_PRICES) + list(GPU_INSTANCE_HOURLY_PRICES)
+
 
 def get_enabled_services_map(properties):
     enabled_services_map = {
@@ -147,10 +303,13 @@ def get_enabled_services_map(properties):
         print(f'{service} is enabled? {status}')
     return enabled_services_map
 
-def get_cluster_requirments(is_multi_node: bool, enabled_services_map: dict):
-    total_cpu = 40.0 if is_multi_node else 9.5
-    total_ram = 47.6 if is_multi_node else 16.4
-    services_requirments = SERVICES_REQUIRMENTS_MAP['multi_node'] if is_multi_node else SERVICES_REQUIRMENTS_MAP['single_node']
+def get_cluster_requirments(is_multi_node: bool, enabled_services_map: dict,
+                            base_requirements: dict = BASE_REQUIREMENTS,
+                            services_requirments_map: dict = SERVICES_REQUIRMENTS_MAP):
+    node_mode = 'multi_node' if is_multi_node else 'single_node'
+    total_cpu = base_requirements[node_mode]['cpu']
+    total_ram = base_requirements[node_mode]['ram']
+    services_requirments = services_requirments_map[node_mode]
 
     for service, is_enabled in enabled_services_map.items():
         if is_enabled:
@@ -160,74 +319,127 @@ def get_cluster_requirments(is_multi_node: bool, enabled_services_map: dict):
             total_ram += services_requirments[service]['ram']
     return total_cpu, total_ram
 
-def get_instance_from_list(types_list: list, region: str) -> dict:
-    ec2 = boto3.client('ec2', region_name=region)
-    type_offerings = ec2.describe_instance_type_offerings(
-        LocationType='region',
-        Filters=[
-            {
-                'Name': 'location',
-                'Values': [region]
-            },
-            {
-                'Name': 'instance-type',
-                'Values': types_list
-            }
-        ]
-    )
-    print("Available instance types:")
-    print(json.dumps(type_offerings))
-    available_types = [crt_type['InstanceType'] for crt_type in type_offerings['InstanceTypeOfferings']]
-    print("Available instance types, short list:")
-    print(available_types)
-    if not available_types:
-        raise Exception("No offerings available in the region")
-    types = ec2.describe_instance_types(
-        InstanceTypes=available_types,
-        Filters=[
-            {
-                'Name': 'supported-virtualization-type',
-                'Values': ['hvm']
-            }
-        ]
+def get_gp3_performance(size: int, iops: int, throughput: int):
+    iops = min(max(iops, BASE_STORAGE['iops']), GP3_MAX_IOPS, size * GP3_MAX_IOPS_PER_GB)
+    throughput = min(max(throughput, BASE_STORAGE['throughput']), GP3_MAX_THROUGHPUT, int(iops * GP3_MAX_THROUGHPUT_PER_IOPS))
+    return iops, throughput
+
+
+def get_storage_requirements(enabled_services_map: dict) -> dict:
+    data_disk = BASE_STORAGE['data_disk']
+    iops = BASE_STORAGE['iops']
+    throughput = BASE_STORAGE['throughput']
+    enabled_count = 0
+    for service, is_enabled in enabled_services_map.items():
+        if is_enabled and service != 'platform':
+            enabled_count += 1
+            data_disk += SERVICES_STORAGE_MAP[service]['disk']
+            iops += SERVICES_STORAGE_MAP[service]['iops']
+            throughput += SERVICES_STORAGE_MAP[service]['throughput']
+    data_disk = int(math.ceil(data_disk / DISK_SIZE_GRANULARITY)) * DISK_SIZE_GRANULARITY
+    data_iops, data_throughput = get_gp3_performance(data_disk, iops, throughput)
+    etcd_iops, etcd_throughput = get_gp3_performance(
+        BASE_STORAGE['etcd_disk'],
+        BASE_STORAGE['iops'] + ETCD_IOPS_PER_SERVICE * enabled_count,
+        BASE_STORAGE['throughput']
     )
-    print(json.dumps(types))
-    if not types['InstanceTypes']:
-        raise Exception("No types available in the region")
+    storage = {
+        "ServerDiskSize": data_disk,
+        "ServerDiskIops": data_iops,
+        "ServerDiskThroughput": data_throughput,
+        "EtcdDiskSize": BASE_STORAGE['etcd_disk'],
+        "EtcdDiskIops": etcd_iops,
+        "EtcdDiskThroughput": etcd_throughput,
+        "ClusterDiskSize": BASE_STORAGE['cluster_disk']
+    }
+    print(f"Storage requirements: {storage}")
+    return storage
+
+
+def is_zone_resilient(zone_count: int) -> bool:
+    """Whether the nodes can be planned so that losing any one of zone_count zones still covers the requirements.
+
+    The server and agent groups balance their own nodes over the zones, so each zone only gets the
+    same number of nodes when zone_count divides the server count, and with it the agent count.
+    """
+    return zone_count >= MIN_RESILIENT_ZONE_COUNT and MIN_MULTI_NODE_COUNT % zone_count == 0
+
+
+def get_agent_scaling_plan(instance_obj: dict, plan: dict, total_cpu: float, total_ram: float, zone_count: int) -> dict:
+    """Agent ASG bounds and CPU target tracking threshold for the selected node shape.
+
+    The minimum covers the unbuffered service requirements and the maximum covers
+    AUTOSCALING_MAX_FACTOR times the buffered requirements. The target policy only sees the
+    agents, so it is the agent utilisation expected at the planned count: the fixed server nodes
+    are assumed loaded up to MAX_TARGET_UTILIZATION and the agents to carry the rest of the demand.
+    """
+    def node_count(cpu, ram):
+        return evaluate_instance(instance_obj, cpu, ram, 0, 0, MIN_MULTI_NODE_COUNT, None, zone_count)['node_count']
+
+    demand_cpu = total_cpu / RESOURCE_BUFFER
+    demand_ram = total_ram / RESOURCE_BUFFER
+    min_nodes = node_count(demand_cpu, demand_ram)
+    max_nodes = node_count(total_cpu * AUTOSCALING_MAX_FACTOR, total_ram * AUTOSCALING_MAX_FACTOR)
+    agent_count = plan['node_count'] - MIN_MULTI_NODE_COUNT
+    server_cpu = MIN_MULTI_NODE_COUNT * plan['instance_cpu'] * MAX_TARGET_UTILIZATION / 100
+    agent_demand_cpu = max(demand_cpu - server_cpu, 0)
+    target_cpu = round(100 * agent_demand_cpu / (agent_count * plan['instance_cpu'])) if agent_count else MAX_TARGET_UTILIZATION
+    scaling_plan = {
+        "AgentMinInstanceCount": min_nodes - MIN_MULTI_NODE_COUNT,
+        "AgentMaxInstanceCount": max(max_nodes, plan['node_count']) - MIN_MULTI_NODE_COUNT,
+        "AgentTargetCpuUtilization": min(max(target_cpu, MIN_TARGET_UTILIZATION), MAX_TARGET_UTILIZATION)
+    }
+    print(f"Agent scaling plan: {scaling_plan}")
+    return scaling_plan
+
 
-    for ret_type in types_list:
-        if ret_type in available_types:
-            return [crt_type for crt_type in types['InstanceTypes'] if crt_type["InstanceType"] == ret_type][0]
+def get_deadline(context) -> float:
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN_SECONDS
 
 
-def create(properties, physical_id):
+def run_role_lookups(lookups: dict, deadline=None) -> dict:
+    """Run the independent per-role instance lookups concurrently and merge the attributes they return.
+
+    Every role that fails, or does not finish before the deadline, is reported in a single exception.
+    """
+    return_attribute = dict()
+    errors = []
+    executor = ThreadPoolExecutor(max_workers=min(MAX_LOOKUP_WORKERS, len(lookups)))
+    try:
+        futures = {role: executor.submit(lookup) for role, lookup in lookups.items()}
+        for role, future in futures.items():
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                return_attribute.update(future.result(timeout=remaining))
+            except FutureTimeoutError:
+                errors.append(f"{role}: lookup did not finish in time")
+            except Exception as e:
+                errors.append(f"{role}: {e}")
+    finally:
+        # do not wait for lookups that overran the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+    if errors:
+        raise Exception("Instance selection failed for " + "; ".join(errors))
+    return return_attribute
+
+
+def compute_sizing(properties, deadline=None):
     region = properties["RegionName"]
     multi_node = properties["MultiNode"]
     gpu = properties['AddGpu']
+    objective = properties.get('SizingObjective', 'cost')
     return_attribute = dict()
 
-    # datadisk size
-    return_attribute["ServerDiskSize"] = 512
     if multi_node.lower() == 'multi node':
         is_multi_node = True
     else:
         is_multi_node = False
 
-    core_multi_node_types = ["c5.4xlarge", "c5a.4xlarge", "m5.4xlarge", "m4.4xlarge"]
-    ext_multi_node_types = ["c5a.8xlarge", "c5.9xlarge", "m5.8xlarge", "m5a.8xlarge"]
-    core_single_node_types = ["c5.4xlarge", "c5a.4xlarge", "m5.4xlarge", "m5a.4xlarge"]
-    ext_single_node_types = ["c5a.8xlarge", "c5.9xlarge", "m5.8xlarge"]
-    tm_node_types = ["c5a.8xlarge", "c5.9xlarge", "c4.8xlarge"]
-    asrobots_node_types = ["c5.4xlarge", "c5a.4xlarge", "m5.4xlarge", "m5a.4xlarge"]
-    gpu_node_types = ["p3.2xlarge", "g4dn.4xlarge", "p2.xlarge", "g5.4xlarge"]
-    
     enabled_services_map = get_enabled_services_map(properties)
+    return_attribute.update(get_storage_requirements(enabled_services_map))
     total_cpu, total_ram = get_cluster_requirments(is_multi_node, enabled_services_map)
-    # Add a 20% procent buffer for the selection
-    total_cpu *= 1.2
-    total_ram *= 1.2
-    min_cpu_per_node = 8
-    min_ram_per_node = 16
+    total_cpu *= RESOURCE_BUFFER
+    total_ram *= RESOURCE_BUFFER
 
     min_cpu_tm_node = 20
     min_ram_tm_node = 60
@@ -239,214 +451,139 @@ def create(properties, physical_id):
     min_ram_gpu_node = 52
     min_gpu_ram_gpu_node = 11
 
-    if is_multi_node:
-        print("Getting instance types for multinode installation")
-        if total_cpu <= 48:
-            instance_obj = get_instance_from_list(types_list=core_multi_node_types, region=region)
+    catalog = get_instance_catalog(region, ALL_NODE_TYPES, deadline)
+
+    def main_lookup():
+        role_attribute = dict()
+        if is_multi_node:
+            print("Getting instance types for multinode installation")
+            subnet_ids = [subnet_id for subnet_id in properties.get('PrivateSubnetIDs', '').split(',') if subnet_id]
+            zones = get_subnet_zones(region, subnet_ids, deadline) if subnet_ids else []
+            if is_zone_resilient(len(zones)):
+                print(f"Planning zone resilient nodes across {zones}")
+                zone_types = get_types_offered_in_zones(region, zones, list(catalog), deadline)
+                main_catalog = {crt_type: instance_obj for crt_type, instance_obj in catalog.items() if crt_type in zone_types}
+                zone_count = len(zones)
+            else:
+                if len(zones) >= MIN_RESILIENT_ZONE_COUNT:
+                    print(f"The {MIN_MULTI_NODE_COUNT} servers cannot be balanced across {zones}, zone resilience is not planned")
+                main_catalog = catalog
+                zone_count = 1
+            # There must be at least 3 servers in a multi-node deployment. As a result the # of nodes is >= 3
+            plan = solve_instance_plan(main_catalog, total_cpu, total_ram, MIN_CPU_PER_NODE, MIN_RAM_PER_NODE,
+                                       min_node_count=MIN_MULTI_NODE_COUNT, objective=objective, zone_count=zone_count)
+            role_attribute["ServerInstanceCount"] = MIN_MULTI_NODE_COUNT
+            role_attribute["AgentInstanceCount"] = plan['node_count'] - MIN_MULTI_NODE_COUNT
+            role_attribute.update(get_agent_scaling_plan(main_catalog[plan['instance_type']], plan, total_cpu, total_ram, zone_count))
         else:
-            instance_obj = get_instance_from_list(types_list=ext_multi_node_types, region=region)
-
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        if instance_ram < min_ram_per_node or instance_cpu < min_cpu_per_node:
-            raise Exception("Minimum Instance HW requirements are not met")
-        # There must be at least 3 servers in a multi-node deployment. As a result the # of nodes is >= 3
-        initial_instance_count = max(int(math.ceil(total_cpu / instance_cpu)), int(math.ceil(total_ram / instance_ram)), 3)
-        return_attribute["ServerInstanceCount"] = 3
-        return_attribute["AgentInstanceCount"] = initial_instance_count - 3
-        return_attribute["InstanceType"] = instance_obj['InstanceType']
-    else:
-        print("single node")
-        if total_cpu <= 16:
-            print("small vm needed")
-            instance_obj = get_instance_from_list(types_list=core_single_node_types, region=region)
-        else:
-            print("big vm needed")
-            instance_obj = get_instance_from_list(types_list=ext_single_node_types, region=region)
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        if instance_ram < total_ram or instance_cpu < total_cpu:
-            raise Exception("Minimum Instance HW requirements are not met")
-        return_attribute["ServerInstanceCount"] = 1
-        return_attribute["AgentInstanceCount"] = 0
-        return_attribute["InstanceType"] = instance_obj['InstanceType']
-
-    if properties['TaskMining'].lower() == 'true':
+            print("single node")
+            plan = solve_instance_plan(catalog, total_cpu, total_ram, total_cpu, total_ram,
+                                       max_node_count=1, objective=objective)
+            role_attribute["ServerInstanceCount"] = 1
+            role_attribute["AgentInstanceCount"] = 0
+            role_attribute["AgentMinInstanceCount"] = 0
+            role_attribute["AgentMaxInstanceCount"] = 0
+            role_attribute["AgentTargetCpuUtilization"] = 0
+        role_attribute["InstanceType"] = plan['instance_type']
+        role_attribute["InstanceTypeAlternatives"] = ','.join(alternative['instance_type'] for alternative in plan['alternatives'])
+        return role_attribute
+
+    def tm_lookup():
         print("Adding Task Mining node")
-        instance_obj = get_instance_from_list(types_list=tm_node_types, region=region)
-
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        if instance_ram < min_ram_tm_node or instance_cpu < min_cpu_tm_node:
-            raise Exception("Minimum Instance HW requirements are not met")
-        return_attribute["TmInstanceType"] = instance_obj['InstanceType']
-    else:
-        return_attribute["TmInstanceType"] = ""
+        plan = solve_instance_plan(catalog, min_cpu_tm_node, min_ram_tm_node, min_cpu_tm_node, min_ram_tm_node,
+                                   max_node_count=1, objective=objective)
+        return {"TmInstanceType": plan['instance_type']}
 
-    print("Adding AS Robots node config")
-    instance_obj = get_instance_from_list(types_list=asrobots_node_types, region=region)
+    def asrobots_lookup():
+        print("Adding AS Robots node config")
+        plan = solve_instance_plan(catalog, min_cpu_asrobots_node, min_ram_asrobots_node, min_cpu_asrobots_node,
+                                   min_ram_asrobots_node, max_node_count=1, objective=objective)
+        return {"ASRobotsInstanceType": plan['instance_type']}
 
-    instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-    instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-    if instance_ram < min_ram_asrobots_node or instance_cpu < min_cpu_asrobots_node:
-        raise Exception("Minimum Instance HW requirements are not met")
-    return_attribute["ASRobotsInstanceType"] = instance_obj['InstanceType']
-
-    if gpu.lower() == 'true':
+    def gpu_lookup():
         print("Adding Gpu node")
-        instance_obj = get_instance_from_list(types_list=gpu_node_types, region=region)
-
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        instance_gpu_ram = instance_obj["GpuInfo"]['Gpus'][0]['MemoryInfo']['SizeInMiB'] // 1024
-        if instance_ram < min_ram_gpu_node or instance_cpu < min_cpu_gpu_node or instance_gpu_ram < min_gpu_ram_gpu_node:
-            raise Exception("Minimum Instance HW requirements are not met")
-        return_attribute["GpuInstanceType"] = instance_obj['InstanceType']
-    else:
-        return_attribute["GpuInstanceType"] = ""
-
-    return_attribute['Action'] = 'CREATE'
-    return cfnresponse.SUCCESS, physical_id, return_attribute
-
-
-def update(properties, physical_id):
-    region = properties["RegionName"]
-    multi_node = properties["MultiNode"]
-    gpu = properties['AddGpu']
-    return_attribute = dict()
+        plan = solve_gpu_plan(catalog, min_cpu_gpu_node, min_ram_gpu_node, min_gpu_ram_gpu_node)
+        return {"GpuInstanceType": plan['instance_type']}
 
-    # datadisk size
-    return_attribute["ServerDiskSize"] = 512
-    if multi_node.lower() == 'multi node':
-        is_multi_node = True
-    else:
-        is_multi_node = False
-
-    core_multi_node_types = ["c5.4xlarge", "c5a.4xlarge", "m5.4xlarge", "m4.4xlarge"]
-    ext_multi_node_types = ["c5a.8xlarge", "c5.9xlarge", "m5.8xlarge", "m5a.8xlarge"]
-    core_single_node_types = ["c5.4xlarge", "c5a.4xlarge", "m5.4xlarge", "m5a.4xlarge"]
-    ext_single_node_types = ["c5a.8xlarge", "c5.9xlarge", "m5.8xlarge"]
-    tm_node_types = ["c5a.8xlarge", "c5.9xlarge", "c4.8xlarge"]
-    asrobots_node_types = ["c5.4xlarge", "c5a.4xlarge", "m5.4xlarge", "m5a.4xlarge"]
-    gpu_node_types = ["p3.2xlarge", "g4dn.4xlarge", "p2.xlarge", "g5.4xlarge"]
-    
-    enabled_services_map = get_enabled_services_map(properties)
-    total_cpu, total_ram = get_cluster_requirments(is_multi_node, enabled_services_map)
-    # Add a 20% procent buffer for the selection
-    total_cpu *= 1.2
-    total_ram *= 1.2
-    min_cpu_per_node = 8
-    min_ram_per_node = 16
-
-    min_cpu_tm_node = 20
-    min_ram_tm_node = 60
+    lookups = {'main': main_lookup, 'asrobots': asrobots_lookup}
+    return_attribute["TmInstanceType"] = ""
+    if properties['TaskMining'].lower() == 'true':
+        lookups['task_mining'] = tm_lookup
+    return_attribute["GpuInstanceType"] = ""
+    if gpu.lower() == 'true':
+        lookups['gpu'] = gpu_lookup
+    return_attribute.update(run_role_lookups(lookups, deadline))
 
-    min_cpu_asrobots_node = 16
-    min_ram_asrobots_node = 32
+    return return_attribute
 
-    min_cpu_gpu_node = 8
-    min_ram_gpu_node = 52
-    min_gpu_ram_gpu_node = 11
 
-    if is_multi_node:
-        print("Getting instance types for multinode installation")
-        if total_cpu <= 48:
-            instance_obj = get_instance_from_list(types_list=core_multi_node_types, region=region)
-        else:
-            instance_obj = get_instance_from_list(types_list=ext_multi_node_types, region=region)
-
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        if instance_ram < min_ram_per_node or instance_cpu < min_cpu_per_node:
-            raise Exception("Minimum Instance HW requirements are not met")
-        # There must be at least 3 servers in a multi-node deployment. As a result the # of nodes is >= 3
-        initial_instance_count = max(int(math.ceil(total_cpu / instance_cpu)), int(math.ceil(total_ram / instance_ram)), 3)
-        return_attribute["ServerInstanceCount"] = 3
-        return_attribute["AgentInstanceCount"] = initial_instance_count - 3
-        return_attribute["InstanceType"] = instance_obj['InstanceType']
-    else:
-        print("single node")
-        if total_cpu <= 16:
-            print("small vm needed")
-            instance_obj = get_instance_from_list(types_list=core_single_node_types, region=region)
-        else:
-            print("big vm needed")
-            instance_obj = get_instance_from_list(types_list=ext_single_node_types, region=region)
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        if instance_ram < total_ram or instance_cpu < total_cpu:
-            raise Exception("Minimum Instance HW requirements are not met")
-        return_attribute["ServerInstanceCount"] = 1
-        return_attribute["AgentInstanceCount"] = 0
-        return_attribute["InstanceType"] = instance_obj['InstanceType']
+def get_sizing_hash(properties: dict) -> str:
+    sizing_inputs = {key: str(properties.get(key, '')).strip().lower() for key in SIZING_PROPERTIES}
+    sizing_inputs['SchemaVersion'] = SIZING_SCHEMA_VERSION
+    return hashlib.sha256(json.dumps(sizing_inputs, sort_keys=True).encode('utf-8')).hexdigest()[:PHYSICAL_ID_HASH_LENGTH]
 
-    if properties['TaskMining'].lower() == 'true':
-        print("Adding Task Mining node")
-        instance_obj = get_instance_from_list(types_list=tm_node_types, region=region)
 
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        if instance_ram < min_ram_tm_node or instance_cpu < min_cpu_tm_node:
-            raise Exception("Minimum Instance HW requirements are not met")
-        return_attribute["TmInstanceType"] = instance_obj['InstanceType']
-    else:
-        return_attribute["TmInstanceType"] = ""
+def encode_physical_id(sizing_hash: str, return_attribute: dict) -> str:
+    """Persist the computed attributes in the physical ID so a no-op update can return them as they are."""
+    attributes = {key: value for key, value in return_attribute.items() if key != 'Action'}
+    payload = base64.urlsafe_b64encode(zlib.compress(json.dumps(attributes, sort_keys=True).encode('utf-8'))).decode('ascii')
+    physical_id = f"{PHYSICAL_ID_PREFIX}:{sizing_hash}:{payload}"
+    if len(physical_id) > MAX_PHYSICAL_ID_LENGTH:
+        print("Sizing attributes do not fit in the physical ID, the next update will recompute them")
+        return f"{PHYSICAL_ID_PREFIX}:{sizing_hash}:"
+    return physical_id
 
-    print("Adding AS Robots node config")
-    instance_obj = get_instance_from_list(types_list=asrobots_node_types, region=region)
 
-    instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-    instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-    if instance_ram < min_ram_asrobots_node or instance_cpu < min_cpu_asrobots_node:
-        raise Exception("Minimum Instance HW requirements are not met")
-    return_attribute["ASRobotsInstanceType"] = instance_obj['InstanceType']
+def decode_physical_id(physical_id: str):
+    """Return the sizing hash and attributes stored in physical_id, or None for IDs without them."""
+    parts = (physical_id or '').split(':')
+    if len(parts) != 3 or parts[0] != PHYSICAL_ID_PREFIX or not parts[2]:
+        return None
+    try:
+        attributes = json.loads(zlib.decompress(base64.urlsafe_b64decode(parts[2])))
+    except Exception as e:
+        print(f"Failed to decode the sizing attributes from the physical ID: {e}")
+        return None
+    return parts[1], attributes
 
-    if gpu.lower() == 'true':
-        print("Adding Gpu node")
-        instance_obj = get_instance_from_list(types_list=gpu_node_types, region=region)
-
-        instance_cpu = instance_obj["VCpuInfo"]['DefaultVCpus']
-        instance_ram = instance_obj["MemoryInfo"]['SizeInMiB'] // 1024
-        instance_gpu_ram = instance_obj["GpuInfo"]['Gpus'][0]['MemoryInfo']['SizeInMiB'] // 1024
-        if instance_ram < min_ram_gpu_node or instance_cpu < min_cpu_gpu_node or instance_gpu_ram < min_gpu_ram_gpu_node:
-            raise Exception("Minimum Instance HW requirements are not met")
-        return_attribute["GpuInstanceType"] = instance_obj['InstanceType']
-    else:
-        return_attribute["GpuInstanceType"] = ""
 
+def create(properties, physical_id, context):
+    return_attribute = compute_sizing(properties, get_deadline(context))
+    new_physical_id = encode_physical_id(get_sizing_hash(properties), return_attribute)
+    return_attribute['Action'] = 'CREATE'
+    return cfnresponse.SUCCESS, new_physical_id, return_attribute
+
+
+def update(properties, physical_id, context, old_properties=None):
+    sizing_hash = get_sizing_hash(properties)
+    previous = decode_physical_id(physical_id)
+    if previous is not None and previous[0] == sizing_hash:
+        print("Sizing inputs did not change, returning the previous attributes")
+        return_attribute = previous[1]
+        return_attribute['Action'] = 'UPDATE'
+        return cfnresponse.SUCCESS, physical_id, return_attribute
+
+    if old_properties is not None:
+        changed_properties = [
+            key for key in SIZING_PROPERTIES
+            if str(old_properties.get(key, '')).strip().lower() != str(properties.get(key, '')).strip().lower()
+        ]
+        print(f"Sizing inputs changed: {changed_properties}")
+    return_attribute = compute_sizing(properties, get_deadline(context))
+    new_physical_id = encode_physical_id(sizing_hash, return_attribute)
     return_attribute['Action'] = 'UPDATE'
-    return cfnresponse.SUCCESS, physical_id, return_attribute
+    return cfnresponse.SUCCESS, new_physical_id, return_attribute
 
 
-def delete(properties, physical_id):
+def delete(properties, physical_id, context):
     return_attribute = {'Action': 'DELETE'}
     return cfnresponse.SUCCESS, physical_id, return_attribute
 
 
-def timeout(event, context):
-    print('Execution is about to time out, sending failure response to CloudFormation')
-    cfnresponse.send(event, context, cfnresponse.FAILED, {}, None)
-
-
 def handler(event, context):
-    # make sure we send a failure to CloudFormation if the function is going to timeout
-    timer = threading.Timer((context.get_remaining_time_in_millis() / 1000.00) - 0.5, timeout, args=[event, context])
-    timer.start()
-    print('Received event: ' + json.dumps(event))
-    status = cfnresponse.FAILED
-    new_physical_id = None
-    returnAttribute = {}
-    try:
-        properties = event.get('ResourceProperties')
-        physical_id = event.get('PhysicalResourceId')
-        status, new_physical_id, returnAttribute = {
-            'Create': create,
-            'Update': update,
-            'Delete': delete
-        }.get(event['RequestType'], lambda x, y: (cfnresponse.FAILED, None))(properties, physical_id)
-    except Exception as e:
-        print('Exception: ' + str(e))
-        status = cfnresponse.FAILED
-    finally:
-        timer.cancel()
-        cfnresponse.send(event, context, status, returnAttribute, new_physical_id)
+    cfnruntime.handle(event, context, {
+        'Create': lambda properties, physical_id: create(properties, physical_id, context),
+        'Update': lambda properties, physical_id: update(properties, physical_id, context,
+                                                         event.get('OldResourceProperties')),
+        'Delete': lambda properties, physical_id: delete(properties, physical_id, context)
+    })
@@ -0,0 +1,222 @@
+"""Right-sizing recommendations from utilisation samples exported from running clusters.
+
+Reads CSV or JSON dumps of pod and node CPU/RAM usage, computes the p95 demand of every service,
+proposes updated SERVICES_REQUIRMENTS_MAP coefficients and sizes each cluster again with them
+through the same path as ComputeResourceSize, without calling any AWS API:
+
+    python rightsizing.py --region us-east-1 samples.csv more-samples.json [--output report.json]
+
+Every sample has the fields below (CSV header or JSON object keys, a JSON file holds a list of
+samples or an object with a "samples" list):
+
+    timestamp     sampling time, samples sharing a timestamp are summed together
+    cluster       cluster the sample comes from
+    kind          "pod" or "node"
+    name          pod or node name
+    service       optional, service key of SERVICES_REQUIRMENTS_MAP; derived from the pod name when empty
+    cpu_cores     CPU in use, in cores
+    memory_gib    memory in use, in GiB
+    cpu_capacity, memory_capacity_gib   node rows only, allocatable capacity of the node
+"""
+import argparse
+import csv
+import json
+import math
+from instance_catalog import load_offline_catalog
+from instance_solver import INSTANCE_HOURLY_PRICES, solve_instance_plan
+from lambda_function import (
+    BASE_REQUIREMENTS, MIN_CPU_PER_NODE, MIN_MULTI_NODE_COUNT, MIN_RAM_PER_NODE, RESOURCE_BUFFER,
+    SERVICES_REQUIRMENTS_MAP, get_cluster_requirments
+)
+
+DEMAND_PERCENTILE = 95
+# Pod name prefixes of every service, pods matching none of them are counted as platform
+SERVICE_POD_PREFIXES = {
+    'orchestrator': ('orchestrator',),
+    'action_center': ('action-center', 'actioncenter'),
+    'test_manager': ('test-manager', 'testmanager'),
+    'insights': ('insights',),
+    'dataservice': ('dataservice', 'data-service'),
+    'automation_hub': ('automation-hub', 'automationhub'),
+    'automation_ops': ('automation-ops', 'automationops'),
+    'task_mining': ('task-mining', 'taskmining'),
+    'aicenter': ('aicenter', 'ai-app', 'ai-deployer', 'ai-helper', 'ai-pkgmanager', 'ai-trainer'),
+    'documentunderstanding': ('du-', 'documentunderstanding'),
+    'apps': ('apps', 'app-studio'),
+    'processmining': ('processmining', 'process-mining'),
+    'asrobots': ('asrobots', 'robot')
+}
+
+
+def percentile(values: list, rank: float) -> float:
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    return ordered[max(int(math.ceil(rank / 100 * len(ordered))) - 1, 0)]
+
+
+def get_pod_service(pod_name: str) -> str:
+    for service, prefixes in SERVICE_POD_PREFIXES.items():
+        if pod_name.startswith(prefixes):
+            return service
+    return 'platform'
+
+
+def load_samples(path: str) -> list:
+    if path.endswith('.json'):
+        with open(path) as samples_file:
+            document = json.load(samples_file)
+        rows = document['samples'] if isinstance(document, dict) else document
+    else:
+        with open(path, newline='') as samples_file:
+            rows = list(csv.DictReader(samples_file))
+
+    samples = []
+    for row in rows:
+        kind = row['kind'].lower()
+        if kind not in ('pod', 'node'):
+            raise Exception(f"Unknown sample kind {row['kind']} in {path}")
+        sample = {
+            'timestamp': str(row['timestamp']),
+            'cluster': row.get('cluster') or 'default',
+            'kind': kind,
+            'name': row['name'],
+            'cpu': float(row['cpu_cores']),
+            'ram': float(row['memory_gib'])
+        }
+        if kind == 'pod':
+            sample['service'] = row.get('service') or get_pod_service(row['name'])
+            if sample['service'] not in SERVICES_REQUIRMENTS_MAP['multi_node']:
+                raise Exception(f"Unknown service {sample['service']} for pod {row['name']} in {path}")
+        else:
+            sample['cpu_capacity'] = float(row.get('cpu_capacity') or 0)
+            sample['ram_capacity'] = float(row.get('memory_capacity_gib') or 0)
+        samples.append(sample)
+    print(f"Loaded {len(samples)} samples from {path}")
+    return samples
+
+
+def get_service_demand(pod_samples: list) -> dict:
+    """p95 over time of the summed CPU/RAM of every service's pods."""
+    usage = {}
+    for sample in pod_samples:
+        service_usage = usage.setdefault(sample['service'], {}).setdefault(sample['timestamp'], [0.0, 0.0])
+        service_usage[0] += sample['cpu']
+        service_usage[1] += sample['ram']
+    return {
+        service: {
+            'cpu': round(percentile([cpu for cpu, _ in timestamps.values()], DEMAND_PERCENTILE), 1),
+            'ram': round(percentile([ram for _, ram in timestamps.values()], DEMAND_PERCENTILE), 1)
+        }
+        for service, timestamps in usage.items()
+    }
+
+
+def get_provisioned_capacity(node_samples: list):
+    """Node count and allocatable CPU/RAM of the cluster at its latest sampled timestamp."""
+    if not node_samples:
+        return None
+    latest = max(sample['timestamp'] for sample in node_samples)
+    nodes = {sample['name']: sample for sample in node_samples if sample['timestamp'] == latest}
+    return {
+        'node_count': len(nodes),
+        'cpu': round(sum(node['cpu_capacity'] for node in nodes.values()), 1),
+        'ram': round(sum(node['ram_capacity'] for node in nodes.values()), 1)
+    }
+
+
+def size_cluster(catalog: dict, is_multi_node: bool, enabled_services_map: dict, base_requirements: dict,
+                 services_requirments_map: dict, objective: str) -> dict:
+    """Main node plan for the given requirement model, as computed by ComputeResourceSize."""
+    total_cpu, total_ram = get_cluster_requirments(is_multi_node, enabled_services_map, base_requirements,
+                                                   services_requirments_map)
+    total_cpu *= RESOURCE_BUFFER
+    total_ram *= RESOURCE_BUFFER
+    if is_multi_node:
+        plan = solve_instance_plan(catalog, total_cpu, total_ram, MIN_CPU_PER_NODE, MIN_RAM_PER_NODE,
+                                   min_node_count=MIN_MULTI_NODE_COUNT, objective=objective)
+    else:
+        plan = solve_instance_plan(catalog, total_cpu, total_ram, total_cpu, total_ram,
+                                   max_node_count=1, objective=objective)
+    return {
+        'instance_type': plan['instance_type'],
+        'node_count': plan['node_count'],
+        'cpu': plan['node_count'] * plan['instance_cpu'],
+        'ram': plan['node_count'] * plan['instance_ram'],
+        'hourly_cost': plan['hourly_cost']
+    }
+
+
+def recommend_cluster(cluster: str, samples: list, catalog: dict, is_multi_node=None, objective: str = 'cost') -> dict:
+    pod_samples = [sample for sample in samples if sample['kind'] == 'pod']
+    node_samples = [sample for sample in samples if sample['kind'] == 'node']
+    if not pod_samples:
+        raise Exception(f"No pod samples for cluster {cluster}")
+    if is_multi_node is None:
+        is_multi_node = len({sample['name'] for sample in node_samples}) > 1
+    node_mode = 'multi_node' if is_multi_node else 'single_node'
+
+    demand = get_service_demand(pod_samples)
+    enabled_services_map = {service: service in demand for service in SERVICES_REQUIRMENTS_MAP[node_mode]}
+    enabled_services_map['platform'] = True
+    # The observed platform usage replaces the baseline, which already accounts for the platform
+    base_demand = demand.pop('platform', BASE_REQUIREMENTS[node_mode])
+    proposed_base = dict(BASE_REQUIREMENTS, **{node_mode: base_demand})
+    proposed_map = dict(SERVICES_REQUIRMENTS_MAP, **{node_mode: dict(SERVICES_REQUIRMENTS_MAP[node_mode], **demand)})
+
+    current_plan = size_cluster(catalog, is_multi_node, enabled_services_map, BASE_REQUIREMENTS,
+                                SERVICES_REQUIRMENTS_MAP, objective)
+    proposed_plan = size_cluster(catalog, is_multi_node, enabled_services_map, proposed_base, proposed_map, objective)
+    provisioned = get_provisioned_capacity(node_samples) or current_plan
+    report = {
+        'cluster': cluster,
+        'node_mode': node_mode,
+        'base_requirements': {'current': BASE_REQUIREMENTS[node_mode], 'proposed': base_demand},
+        'services': {
+            service: {'current': SERVICES_REQUIRMENTS_MAP[node_mode][service], 'proposed': service_demand}
+            for service, service_demand in sorted(demand.items())
+        },
+        'provisioned': provisioned,
+        'current_plan': current_plan,
+        'proposed_plan': proposed_plan,
+        # both plans come from the same model and catalog, the provisioned capacity is only reported
+        'reclaimable': {
+            'cpu': round(current_plan['cpu'] - proposed_plan['cpu'], 1),
+            'ram': round(current_plan['ram'] - proposed_plan['ram'], 1),
+            'hourly_cost': round(current_plan['hourly_cost'] - proposed_plan['hourly_cost'], 4)
+        }
+    }
+    print(f"{cluster}: {current_plan['node_count']} x {current_plan['instance_type']} -> "
+          f"{proposed_plan['node_count']} x {proposed_plan['instance_type']}, reclaimable {report['reclaimable']}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recommend sizing coefficients and instance plans from utilisation samples')
+    parser.add_argument('samples', nargs='+', help='CSV or JSON sample files')
+    parser.add_argument('--region', required=True, help='Region whose instance offerings are used')
+    parser.add_argument('--objective', choices=('cost', 'waste'), default='cost')
+    parser.add_argument('--node-mode', choices=('single_node', 'multi_node'),
+                        help='Node mode of the clusters, derived from the node samples by default')
+    parser.add_argument('--catalog', help='JSON list of describe_instance_types entries to use instead of the snapshot')
+    parser.add_argument('--output', help='Report file, printed to stdout by default')
+    args = parser.parse_args()
+
+    samples = [sample for path in args.samples for sample in load_samples(path)]
+    catalog = load_offline_catalog(args.region, list(INSTANCE_HOURLY_PRICES), args.catalog)
+    is_multi_node = None if args.node_mode is None else args.node_mode == 'multi_node'
+    clusters = sorted({sample['cluster'] for sample in samples})
+    reports = [
+        recommend_cluster(cluster, [sample for sample in samples if sample['cluster'] == cluster], catalog,
+                          is_multi_node, args.objective)
+        for cluster in clusters
+    ]
+    report = json.dumps({'clusters': reports}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
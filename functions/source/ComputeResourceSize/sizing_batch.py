@@ -0,0 +1,173 @@
+"""Vectorized what-if sizing over many service combinations, for offline capacity planning.
+
+Reproduces the main node selection of ComputeResourceSize for every row of an enabled-services
+matrix in a single NumPy pass, without calling any AWS API. The candidate types come from the
+offline instance catalog snapshot (see build_instance_catalog.py) or from a JSON file holding a
+list of describe_instance_types entries.
+
+    python sizing_batch.py --region us-east-1 --output sizing.csv
+    python sizing_batch.py --region eu-west-1 --modes multi_node --objective waste --output sizing.parquet
+    python sizing_batch.py --region us-east-1 --modes multi_node --zones 3 --output sizing.csv
+
+--zones applies the zone resilience of multi node deployments across that many zones, when the
+servers can be balanced across them as the Lambda requires; the types offered in only some of the
+zones are not filtered out as the Lambda does.
+
+This module is not used by the Lambda handler and needs numpy (and pandas with pyarrow for Parquet).
+"""
+import argparse
+import csv
+import numpy as np
+from instance_catalog import load_offline_catalog
+from instance_solver import INSTANCE_HOURLY_PRICES, OBJECTIVES, is_eligible
+from lambda_function import (
+    BASE_REQUIREMENTS, MIN_CPU_PER_NODE, MIN_MULTI_NODE_COUNT, MIN_RAM_PER_NODE, MIN_RESILIENT_ZONE_COUNT,
+    RESOURCE_BUFFER, SERVICES_REQUIRMENTS_MAP, is_zone_resilient
+)
+
+NODE_MODES = ('single_node', 'multi_node')
+# Platform is always enabled and already part of the baseline requirements
+SERVICES = [service for service in SERVICES_REQUIRMENTS_MAP['multi_node'] if service != 'platform']
+
+
+def all_service_combinations() -> np.ndarray:
+    """Every enabled/disabled combination of SERVICES, one row per combination."""
+    combinations = np.arange(2 ** len(SERVICES), dtype=np.uint32)
+    return ((combinations[:, None] >> np.arange(len(SERVICES), dtype=np.uint32)) & 1).astype(bool)
+
+
+def candidate_arrays(catalog: dict):
+    candidates = sorted(instance_type for instance_type, instance_obj in catalog.items() if is_eligible(instance_obj))
+    if not candidates:
+        raise Exception("No eligible instance types in the catalog")
+    cpu = np.array([catalog[name]['VCpuInfo']['DefaultVCpus'] for name in candidates], dtype=np.float64)
+    ram = np.array([catalog[name]['MemoryInfo']['SizeInMiB'] // 1024 for name in candidates], dtype=np.float64)
+    price = np.array([INSTANCE_HOURLY_PRICES[name] for name in candidates], dtype=np.float64)
+    return candidates, cpu, ram, price
+
+
+def size_batch(enabled_services: np.ndarray, multi_node: np.ndarray, catalog: dict, objective: str = 'cost',
+               zone_count: int = 1) -> dict:
+    """Size every row of enabled_services (rows x len(SERVICES) booleans) in one vectorized pass.
+
+    multi_node is a boolean vector with one entry per row. When is_zone_resilient(zone_count)
+    holds, the multi node rows are sized like evaluate_instance does: the same
+    number of nodes in every zone, the surviving zones alone covering the requirements. Returns a
+    dict of column arrays holding the buffered CPU/RAM totals, the chosen instance type, node
+    counts and hourly cost of each row. Rows that no candidate can satisfy get an empty instance
+    type and a node count of 0.
+    """
+    if objective not in OBJECTIVES:
+        raise Exception(f"Unknown sizing objective {objective}")
+    enabled_services = np.asarray(enabled_services, dtype=bool)
+    multi_node = np.asarray(multi_node, dtype=bool)
+    mode_index = multi_node.astype(np.intp)
+
+    cpu_coefficients = np.array([[SERVICES_REQUIRMENTS_MAP[mode][service]['cpu'] for service in SERVICES] for mode in NODE_MODES])
+    ram_coefficients = np.array([[SERVICES_REQUIRMENTS_MAP[mode][service]['ram'] for service in SERVICES] for mode in NODE_MODES])
+    base_cpu = np.array([BASE_REQUIREMENTS[mode]['cpu'] for mode in NODE_MODES])
+    base_ram = np.array([BASE_REQUIREMENTS[mode]['ram'] for mode in NODE_MODES])
+
+    total_cpu = (base_cpu[mode_index] + np.einsum('ij,ij->i', enabled_services, cpu_coefficients[mode_index])) * RESOURCE_BUFFER
+    total_ram = (base_ram[mode_index] + np.einsum('ij,ij->i', enabled_services, ram_coefficients[mode_index])) * RESOURCE_BUFFER
+
+    candidates, instance_cpu, instance_ram, price = candidate_arrays(catalog)
+    min_node_count = np.where(multi_node, MIN_MULTI_NODE_COUNT, 1)[:, None]
+    required_nodes = np.maximum(np.ceil(total_cpu[:, None] / instance_cpu), np.ceil(total_ram[:, None] / instance_ram))
+    node_count = np.maximum(required_nodes, min_node_count)
+    nodes_per_zone = np.zeros_like(node_count)
+    if is_zone_resilient(zone_count):
+        zone_resilient = multi_node[:, None]
+        nodes_per_zone = np.where(
+            zone_resilient,
+            np.maximum(np.ceil(required_nodes / (zone_count - 1)), np.ceil(min_node_count / zone_count)),
+            0
+        )
+        node_count = np.where(zone_resilient, nodes_per_zone * zone_count, node_count)
+    meets_node_minimum = (instance_cpu >= MIN_CPU_PER_NODE) & (instance_ram >= MIN_RAM_PER_NODE)
+    feasible = np.where(multi_node[:, None], meets_node_minimum[None, :], node_count == 1)
+
+    cluster_cpu = node_count * instance_cpu
+    cluster_ram = node_count * instance_ram
+    # Same rounding as instance_solver so both pick the same type on ties
+    cost = np.where(feasible, np.round(node_count * price, 4), np.inf)
+    waste = np.where(
+        feasible,
+        np.round((cluster_cpu - total_cpu[:, None]) / cluster_cpu + (cluster_ram - total_ram[:, None]) / cluster_ram, 4),
+        np.inf
+    )
+    name_rank = np.broadcast_to(np.arange(len(candidates)), cost.shape)
+    # np.lexsort sorts by the last key first
+    if objective == 'cost':
+        order = np.lexsort((name_rank, node_count, waste, cost), axis=-1)
+    else:
+        order = np.lexsort((name_rank, node_count, cost, waste), axis=-1)
+    best = order[:, 0]
+    rows = np.arange(len(best))
+    solved = feasible[rows, best]
+
+    chosen_count = np.where(solved, node_count[rows, best], 0).astype(np.int64)
+    server_count = np.where(solved, np.where(multi_node, MIN_MULTI_NODE_COUNT, 1), 0)
+    return {
+        'multi_node': multi_node,
+        'total_cpu': np.round(total_cpu, 2),
+        'total_ram': np.round(total_ram, 2),
+        'instance_type': np.where(solved, np.array(candidates, dtype=object)[best], ''),
+        'node_count': chosen_count,
+        'nodes_per_zone': np.where(solved, nodes_per_zone[rows, best], 0).astype(np.int64),
+        'server_instance_count': server_count,
+        'agent_instance_count': chosen_count - server_count,
+        'hourly_cost': np.where(solved, cost[rows, best], np.nan)
+    }
+
+
+def what_if_matrix(modes: tuple = NODE_MODES):
+    """All service combinations repeated for every node mode in modes."""
+    combinations = all_service_combinations()
+    enabled_services = np.concatenate([combinations] * len(modes))
+    multi_node = np.repeat(np.array([mode == 'multi_node' for mode in modes]), len(combinations))
+    return enabled_services, multi_node
+
+
+def write_results(path: str, enabled_services: np.ndarray, results: dict):
+    columns = {service: enabled_services[:, position] for position, service in enumerate(SERVICES)}
+    columns.update(results)
+    if path.endswith('.parquet'):
+        try:
+            import pandas
+        except ImportError:
+            raise Exception("Writing Parquet files needs pandas and pyarrow installed")
+        pandas.DataFrame(columns).to_parquet(path, index=False)
+        return
+    with open(path, 'w', newline='') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*(column.tolist() for column in columns.values())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Size every combination of enabled services in one pass')
+    parser.add_argument('--region', required=True, help='Region whose instance offerings are used')
+    parser.add_argument('--output', required=True, help='Result file, .csv or .parquet')
+    parser.add_argument('--modes', nargs='+', choices=NODE_MODES, default=list(NODE_MODES))
+    parser.add_argument('--objective', choices=OBJECTIVES, default='cost')
+    parser.add_argument('--zones', type=int, default=1,
+                        help=f'Zones of the private subnets, multi node deployments are zone resilient from '
+                             f'{MIN_RESILIENT_ZONE_COUNT} zones dividing the {MIN_MULTI_NODE_COUNT} servers')
+    parser.add_argument('--types', nargs='*', help='Restrict the candidate instance types')
+    parser.add_argument('--catalog', help='JSON list of describe_instance_types entries to use instead of the snapshot')
+    args = parser.parse_args()
+
+    catalog = load_offline_catalog(args.region, list(INSTANCE_HOURLY_PRICES), args.catalog)
+    if args.types:
+        catalog = {instance_type: catalog[instance_type] for instance_type in args.types if instance_type in catalog}
+    enabled_services, multi_node = what_if_matrix(tuple(args.modes))
+    results = size_batch(enabled_services, multi_node, catalog, args.objective, args.zones)
+    write_results(args.output, enabled_services, results)
+    zone_note = (f"multi node rows zone resilient across {args.zones} zones" if is_zone_resilient(args.zones)
+                 else "zone resilience not modelled, pass --zones to apply it")
+    print(f"Wrote {len(multi_node)} sizing rows to {args.output}, {zone_note}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Render and validate many random input.json configurations, to catch renderer slowdowns and regressions.
+
+    python benchmark_input_json.py [--count 10000] [--seed 1]
+
+Runs offline, the secrets are placeholders and no AWS API is called.
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+from input_json import SERVICES, render_input_json, validate_document
+
+BASE_PROPERTIES = {
+    'RegionName': 'us-east-1',
+    'AwsUrlSuffix': 'amazonaws.com',
+    'Fqdn': 'automationsuite.example.com',
+    'RDSDBInstanceEndpointAddress': 'db.example.com',
+    'PMRDSDBInstanceEndpointAddress': 'pm-db.example.com',
+    'KubeLoadBalancerDns': 'kube.example.com',
+    'PrivateSubnetIDs': 'subnet-1,subnet-2,subnet-3',
+    'ServerInstanceCount': '3',
+    'AgentInstanceCount': '2',
+    'SelfSignedCertificateValidity': '365',
+    'SharedStorageBucket': '',
+    'UseExternalOrchestrator': 'false',
+    'OrchestratorURL': '',
+    'IdentityURL': '',
+    'OrchestratorCertificate': '',
+    'IdentityCertificate': '',
+    'AddGpu': 'false',
+    'MultiNode': 'Multi Node'
+}
+SECRET = {'username': 'admin', 'password': "p@ss'w}rd"}
+
+
+def random_properties(rng: random.Random) -> dict:
+    properties = dict(BASE_PROPERTIES)
+    properties['MultiNode'] = rng.choice(['Multi Node', 'Single Node'])
+    properties['AddGpu'] = rng.choice(['true', 'false'])
+    properties['SharedStorageBucket'] = rng.choice(['', 'shared-bucket'])
+    for service in SERVICES:
+        if service.enabled:
+            properties[service.enabled] = rng.choice(['true', 'false'])
+        if service.bucket:
+            properties[service.bucket] = f"{service.name}-bucket"
+    return properties
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the input.json renderer')
+    parser.add_argument('--count', type=int, default=10000, help='Configurations to render')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    configurations = [random_properties(rng) for _ in range(args.count)]
+    # the renderer logs every enabled service, keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        for properties in configurations:
+            validate_document(render_input_json(properties, SECRET, SECRET, SECRET, SECRET))
+        elapsed = time.perf_counter() - started
+    print(f"Rendered and validated {args.count} configurations in {elapsed:.3f}s "
+          f"({elapsed / args.count * 1e6:.1f} us each)")
+
+
+if __name__ == '__main__':
+    main()
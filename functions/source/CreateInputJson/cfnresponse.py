@@ -8,18 +8,50 @@
 from __future__ import print_function
 import urllib3
 import json
+import random
+import time
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
-http = urllib3.PoolManager()
+# CloudFormation rejects response bodies larger than this
+MAX_RESPONSE_SIZE = 4096
+CONNECT_TIMEOUT_SECONDS = 5
+READ_TIMEOUT_SECONDS = 10
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+# Time kept to log the outcome before the function times out
+DEADLINE_MARGIN_SECONDS = 0.2
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# kept across warm invocations, so the connection to the response endpoint is reused
+http = urllib3.PoolManager(retries=False)
+
+
+def trim(responseBody):
+    """Drop the largest Data values until the body fits in MAX_RESPONSE_SIZE, naming them in the Reason."""
+    data = dict(responseBody['Data'] or {})
+    reason = responseBody['Reason']
+    dropped = []
+    json_responseBody = json.dumps(responseBody)
+    while len(json_responseBody.encode('utf-8')) > MAX_RESPONSE_SIZE and data:
+        key = max(data, key=lambda k: len(json.dumps(data[k])))
+        del data[key]
+        dropped.append(key)
+        responseBody['Data'] = data
+        responseBody['Reason'] = "{} (response data over {} bytes, dropped {})".format(reason, MAX_RESPONSE_SIZE, ', '.join(dropped))
+        json_responseBody = json.dumps(responseBody)
+    if dropped:
+        print("Response data too large, dropped:", dropped)
+    if len(json_responseBody.encode('utf-8')) > MAX_RESPONSE_SIZE:
+        responseBody['Reason'] = responseBody['Reason'][:256]
+        json_responseBody = json.dumps(responseBody)
+    return json_responseBody
 
 
 def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False, reason=None):
     responseUrl = event['ResponseURL']
 
-    print(responseUrl)
-
     responseBody = {
         'Status' : responseStatus,
         'Reason' : reason or "See the details in CloudWatch Log Stream: {}".format(context.log_stream_name),
@@ -31,21 +63,35 @@ def send(event, context, responseStatus, responseData, physicalResourceId=None,
         'Data' : responseData
     }
 
-    json_responseBody = json.dumps(responseBody)
+    json_responseBody = trim(responseBody)
 
-    print("Response body:")
-    print(json_responseBody)
+    # the presigned URL grants writing the response and the data can hold secrets, neither is logged
+    print("Sending {} response for {} request {}".format(responseStatus, event['LogicalResourceId'], event['RequestId']))
 
     headers = {
         'content-type' : '',
-        'content-length' : str(len(json_responseBody))
+        'content-length' : str(len(json_responseBody.encode('utf-8')))
     }
 
-    try:
-        response = http.request('PUT', responseUrl, headers=headers, body=json_responseBody)
-        print("Status code:", response.status)
-
-
-    except Exception as e:
-
-        print("send(..) failed executing http.request(..):", e)
+    # retry within what is left of the invocation, a lost response blocks the stack for an hour
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN_SECONDS
+    attempt = 0
+    while True:
+        remaining = max(deadline - time.monotonic(), 0.1)
+        timeout = urllib3.Timeout(connect=min(CONNECT_TIMEOUT_SECONDS, remaining), read=min(READ_TIMEOUT_SECONDS, remaining))
+        try:
+            response = http.request('PUT', responseUrl, headers=headers, body=json_responseBody, timeout=timeout)
+            print("Status code:", response.status)
+            if response.status not in RETRYABLE_STATUSES:
+                return
+            error = "status {}".format(response.status)
+        except Exception as e:
+            # connection errors can quote the URL
+            error = type(e).__name__
+        attempt += 1
+        backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        if time.monotonic() + backoff >= deadline:
+            print("send(..) failed executing http.request(..), giving up after {} attempts:".format(attempt), error)
+            return
+        print("send(..) failed executing http.request(..), retrying:", error)
+        time.sleep(backoff)
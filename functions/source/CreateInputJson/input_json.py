@@ -0,0 +1,405 @@
+import base64
+import math
+import random
+import string
+import uuid
+from collections import namedtuple
+from urllib.parse import quote
+
+AICENTER_EXTERNAL_IDENTITY_CERT_PATH = "/root/installer/identity.cer"
+AICENTER_EXTERNAL_ORCH_CERT_PATH = "/root/installer/orchestrator.cer"
+
+# SQL Server has no connection limit worth budgeting against (32767 user connections), the
+# scarce resource is its worker threads, which every concurrently executing request holds.
+# The vCPUs of an RDS instance class come from its size, whatever the family.
+RDS_CLASS_SIZE_VCPUS = {
+    'large': 2,
+    'xlarge': 4,
+    '2xlarge': 8,
+    '4xlarge': 16,
+    '8xlarge': 32,
+    '12xlarge': 48,
+    '16xlarge': 64,
+    '24xlarge': 96
+}
+DEFAULT_RDS_INSTANCE_CLASS = 'db.m5.2xlarge'
+DEFAULT_PM_RDS_INSTANCE_CLASS = 'db.m5.4xlarge'
+# Share of the worker threads left for RDS management, backups and ad hoc sessions
+SQL_RESERVED_WORKER_SHARE = 0.1
+# Replicas each service runs with in the HA profile, in the single node profile every service runs once
+HA_SERVICE_REPLICAS = 3
+# The budget caps each pool, never below a few connections per pool and never above the .NET default Max Pool Size
+MIN_SQL_POOL_SIZE = 10
+MAX_SQL_POOL_SIZE = 100
+SQL_CONNECTION_TIMEOUT = 30
+
+
+def get_sql_max_worker_threads(instance_class: str) -> int:
+    """Default 'max worker threads' of SQL Server 2016 and later on a 64-bit host with the vCPUs of instance_class."""
+    vcpus = RDS_CLASS_SIZE_VCPUS.get(instance_class.rsplit('.', 1)[-1])
+    if vcpus is None:
+        print(f"Unknown RDS instance class {instance_class}, assuming {DEFAULT_RDS_INSTANCE_CLASS}")
+        vcpus = RDS_CLASS_SIZE_VCPUS[DEFAULT_RDS_INSTANCE_CLASS.rsplit('.', 1)[-1]]
+    if vcpus <= 4:
+        return 512
+    if vcpus <= 64:
+        return 512 + (vcpus - 4) * 16
+    return 512 + (vcpus - 4) * 32
+
+
+def get_sql_pool_size(instance_class: str, pool_count: int) -> int:
+    """Max pool size of each of pool_count client pools sharing the SQL instance of instance_class."""
+    budget = get_sql_max_worker_threads(instance_class) * (1 - SQL_RESERVED_WORKER_SHARE)
+    pool_size = int(math.floor(budget / max(pool_count, 1)))
+    return min(max(pool_size, MIN_SQL_POOL_SIZE), MAX_SQL_POOL_SIZE)
+
+
+def get_sql_pools(properties: dict, enabled_services_map: dict, multi_node: bool, initial_number_of_instances: int) -> dict:
+    """.NET Max Pool Size for the main and Process Mining SQL instances.
+
+    The JDBC, ODBC and SQLAlchemy connection strings have no pool size keyword, their pools are
+    configured by the services themselves and keep their defaults.
+    """
+    replicas = min(initial_number_of_instances, HA_SERVICE_REPLICAS) if multi_node else 1
+    sql_services = [service.name for service in SERVICES if service.sql and enabled_services_map[service.name]]
+    pools = {}
+    for name, instance_class, pool_count in [
+        ('main', properties.get('RDSDBInstanceClass') or DEFAULT_RDS_INSTANCE_CLASS, len(sql_services) * replicas),
+        ('processmining', properties.get('PMRDSDBInstanceClass') or DEFAULT_PM_RDS_INSTANCE_CLASS, replicas)
+    ]:
+        pool_size = get_sql_pool_size(instance_class, pool_count)
+        print(f"SQL pool size for {name} ({instance_class}, {pool_count} client pools): {pool_size}")
+        pools[name] = pool_size
+    return pools
+
+
+def orchestrator_blocks(context: dict, enabled: bool) -> dict:
+    return {
+        'testautomation': {"enabled": enabled},
+        'updateserver': {"enabled": enabled}
+    }
+
+
+def processmining_blocks(context: dict) -> dict:
+    pm_db_endpoint = context['properties']['PMRDSDBInstanceEndpointAddress']
+    if not pm_db_endpoint:
+        return {}
+    sql = context['sql']
+    return {
+        "warehouse": {
+            "sql_connection_str": f"Server=tcp:{pm_db_endpoint},1433;Initial Catalog=DB_NAME_PLACEHOLDER;Persist Security Info=False;User Id={sql['username']};Password='{sql['dot_net_escaped_password']}';MultipleActiveResultSets=False;Encrypt=True;TrustServerCertificate=True;Connection Timeout={SQL_CONNECTION_TIMEOUT};Max Pool Size={context['sql_pools']['processmining']};",
+            "sqlalchemy_pyodbc_sql_connection_str": f"mssql+pyodbc://{sql['urlencoded_username']}:{sql['urlencoded_password']}@{pm_db_endpoint}:1433/DB_NAME_PLACEHOLDER?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=YES&Encrypt=YES"
+        }
+    }
+
+
+def aicenter_blocks(context: dict) -> dict:
+    properties = context['properties']
+    if properties['UseExternalOrchestrator'].lower() != "true":
+        return {}
+    return {
+        "orchestrator_url": properties['OrchestratorURL'],
+        "identity_server_url": properties['IdentityURL'],
+        "orchestrator_cert_file_path": AICENTER_EXTERNAL_ORCH_CERT_PATH,
+        "identity_cert_file_path": AICENTER_EXTERNAL_IDENTITY_CERT_PATH,
+        "metering_api_key": "PLACEHOLDER"
+    }
+
+
+def documentunderstanding_blocks(context: dict) -> dict:
+    return {
+        'handwriting': {
+            "enabled": True,
+            "max_cpu_per_pod": 2
+        }
+    }
+
+
+def asrobots_blocks(context: dict) -> dict:
+    return {"packagecaching": True}
+
+
+# One row per service, in document order:
+#   enabled         property holding the service flag, None when the service is always enabled
+#   bucket          property holding the service bucket, None when the service has no bucket
+#   shared_bucket   SharedStorageBucket, when set, replaces the service bucket
+#   blocks          extra blocks of an enabled service, from the render context
+#   always_blocks   extra blocks added whether the service is enabled or not
+#   nodes           dedicated nodes an enabled service adds, from the render context
+#   sql             the service keeps its own connection pools to the main SQL instance
+SERVICE_TABLE = [
+    {'name': 'platform', 'enabled': None, 'bucket': 'PlatformStorageBucket', 'shared_bucket': True, 'sql': True},
+    {'name': 'orchestrator', 'enabled': 'Orchestrator', 'bucket': 'OrchestratorStorageBucket', 'shared_bucket': True,
+     'always_blocks': orchestrator_blocks, 'sql': True},
+    {'name': 'automation_hub', 'enabled': 'AutomationHub', 'sql': True},
+    {'name': 'automation_ops', 'enabled': 'AutomationOps', 'sql': True},
+    {'name': 'action_center', 'enabled': 'ActionCenter', 'sql': True},
+    {'name': 'dataservice', 'enabled': 'DataService', 'bucket': 'DataServiceStorageBucket', 'sql': True},
+    {'name': 'test_manager', 'enabled': 'TestManager', 'bucket': 'TestManagerStorageBucket', 'shared_bucket': True,
+     'sql': True},
+    {'name': 'insights', 'enabled': 'Insights', 'sql': True},
+    {'name': 'apps', 'enabled': 'BusinessApps', 'bucket': 'AppsStorageBucket', 'shared_bucket': True, 'sql': True},
+    {'name': 'task_mining', 'enabled': 'TaskMining', 'bucket': 'TaskMiningStorageBucket', 'shared_bucket': True,
+     'nodes': lambda context: 1, 'sql': True},
+    {'name': 'processmining', 'enabled': 'ProcessMining', 'bucket': 'ProcessMiningStorageBucket',
+     'blocks': processmining_blocks, 'sql': True},
+    {'name': 'aicenter', 'enabled': 'AiCenter', 'bucket': 'AiCenterStorageBucket', 'shared_bucket': True,
+     'blocks': aicenter_blocks, 'sql': True},
+    {'name': 'documentunderstanding', 'enabled': 'DocumentUnderstanding', 'bucket': 'DocumentUnderstandingStorageBucket',
+     'shared_bucket': True, 'blocks': documentunderstanding_blocks, 'sql': True},
+    {'name': 'asrobots', 'enabled': 'ASRobots', 'blocks': asrobots_blocks,
+     'nodes': lambda context: 1 if context['multi_node'] else 0}
+]
+
+Service = namedtuple('Service', ['name', 'enabled', 'bucket', 'shared_bucket', 'blocks', 'always_blocks', 'nodes', 'sql'])
+
+
+def compile_service_table(table: list) -> tuple:
+    services = []
+    for row in table:
+        unknown_fields = set(row) - set(Service._fields)
+        if unknown_fields:
+            raise Exception(f"Unknown fields {sorted(unknown_fields)} for service {row['name']}")
+        fields = dict.fromkeys(Service._fields)
+        fields['shared_bucket'] = False
+        fields['sql'] = False
+        fields.update(row)
+        services.append(Service(**fields))
+    return tuple(services)
+
+
+SERVICES = compile_service_table(SERVICE_TABLE)
+
+# Shape of the rendered document, the service blocks are checked against SERVICES in validate_document
+DOCUMENT_SCHEMA = {
+    'fqdn': str,
+    'rke_token': str,
+    'cloud_template_vendor': str,
+    'cloud_template_source': str,
+    'external_object_storage': {
+        'enabled': bool,
+        'storage_type': str,
+        'region': str,
+        'fqdn': str
+    },
+    'fixed_rke_address': str,
+    'profile': str,
+    'admin_username': str,
+    'admin_password': str,
+    'fabric': {
+        'argocd_admin_password': str,
+        'argocd_user_password': str
+    },
+    'server_certificate': {
+        'ca_cert_file': str,
+        'tls_cert_file': str,
+        'tls_key_file': str
+    },
+    'identity_certificate': {
+        'token_signing_cert_file': str,
+        'token_signing_cert_pass': str
+    },
+    'sql': {
+        'create_db': bool
+    },
+    'sql_connection_string_template': str,
+    'sql_connection_string_template_jdbc': str,
+    'sql_connection_string_template_odbc': str,
+    'sql_connection_string_template_sqlalchemy_pyodbc': str,
+    'infra': {
+        'external_object_storage': {
+            'bucket_name': str
+        }
+    },
+    'initial_number_of_instances': int
+}
+
+
+def compile_schema(schema: dict, path: tuple = ()) -> tuple:
+    """Flatten schema into (path, type) checks."""
+    checks = []
+    for key, expected in schema.items():
+        if isinstance(expected, dict):
+            checks.extend(compile_schema(expected, path + (key,)))
+        else:
+            checks.append((path + (key,), expected))
+    return tuple(checks)
+
+
+DOCUMENT_CHECKS = compile_schema(DOCUMENT_SCHEMA)
+
+
+def validate_document(document: dict):
+    """Raise when document misses a required field, has one of the wrong type or an enabled service lacks its bucket."""
+    errors = []
+    for path, expected in DOCUMENT_CHECKS:
+        value = document
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        # bool is a subclass of int, it must not pass for a count
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            errors.append(f"{'.'.join(path)} should be {expected.__name__}")
+    for service in SERVICES:
+        block = document.get(service.name)
+        if not isinstance(block, dict) or not isinstance(block.get('enabled'), bool):
+            errors.append(f"{service.name}.enabled should be bool")
+        elif block['enabled'] and service.bucket and not block.get('external_object_storage', {}).get('bucket_name'):
+            errors.append(f"{service.name}.external_object_storage.bucket_name is missing")
+    if errors:
+        raise Exception("Invalid input.json: " + "; ".join(errors))
+
+
+def get_enabled_services_map(properties):
+    enabled_services_map = {
+        service.name: service.enabled is None or properties[service.enabled].lower() == "true" for service in SERVICES
+    }
+    print("Enabled services:")
+    for service, status in enabled_services_map.items():
+        print(f'{service} is enabled? {status}')
+    return enabled_services_map
+
+
+def check_certificate(service, base64_encoded_cert):
+    if not base64_encoded_cert:
+        print(f"{service} certificate not provided.")
+        raise Exception("Certificate missing")
+    try:
+        base64.b64decode(base64_encoded_cert, validate=True)
+    except Exception as e:
+        print("Failed to decode base64 certificate provided")
+        raise e
+
+def check_ai_center_external_certificates(properties: dict):
+    check_certificate("Orchestrator", properties['OrchestratorCertificate'])
+    check_certificate("Identity", properties['IdentityCertificate'])
+
+
+def get_service_bucket(service: Service, properties: dict) -> str:
+    if service.shared_bucket and properties['SharedStorageBucket'] != '':
+        return properties['SharedStorageBucket']
+    return properties[service.bucket]
+
+
+def deep_merge(base: dict, overlay: dict) -> dict:
+    """Copy of base with overlay merged in. Nested objects are merged, any other overlay value replaces the base one."""
+    merged = dict(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def render_input_json(properties: dict, platform_secret: dict, argocd_secret: dict, argocd_user_secret: dict,
+                      db_secret: dict, overlays: list = None) -> dict:
+    """Render the installer input.json for the stack properties and the already read secrets.
+
+    overlays are deep merged into the rendered document in list order, so a later overlay wins.
+    """
+    region = properties["RegionName"]
+    aws_url_suffix = properties["AwsUrlSuffix"]
+    db_endpoint = properties["RDSDBInstanceEndpointAddress"]
+    multi_node = properties["MultiNode"].lower() == 'multi node'
+    # a scaling agent group starts at its minimum, the installer waits for the nodes that actually launch
+    initial_agent_count = properties.get('AgentMinInstanceCount') or properties['AgentInstanceCount']
+    initial_number_of_instances = int(properties['ServerInstanceCount']) + int(initial_agent_count)
+
+    enabled_services_map = get_enabled_services_map(properties)
+    if properties['UseExternalOrchestrator'].lower() == "true":
+        check_ai_center_external_certificates(properties)
+
+    ret = {"fqdn": properties["Fqdn"], "rke_token": str(uuid.uuid4())}
+    ret['cloud_template_vendor'] = 'AWS'
+    ret['cloud_template_source'] = 'Quickstart'
+
+    ret['external_object_storage'] = {
+        'enabled': True,
+        'create_bucket': False,
+        'storage_type': 's3',
+        'region': region,
+        'use_instance_profile': True,
+        'port': 443,
+        'fqdn': f's3.{region}.{aws_url_suffix}'
+    }
+
+    ret['fixed_rke_address'] = properties["KubeLoadBalancerDns"]
+    if multi_node:
+        ret['profile'] = 'ha'
+        ret['zone_resilience'] = len(properties['PrivateSubnetIDs'].split(',')) >= 3
+    else:
+        ret['profile'] = 'default'
+
+    if properties['AddGpu'].lower() == 'true':
+        initial_number_of_instances += 1
+    context = {'properties': properties, 'multi_node': multi_node}
+    for service in SERVICES:
+        if service.nodes and enabled_services_map[service.name]:
+            initial_number_of_instances += service.nodes(context)
+
+    print("Adding Platform username and password to JSON")
+    ret["admin_username"] = platform_secret['username']
+    ret["admin_password"] = platform_secret['password']
+
+    print("Adding ArgoCD username and password to JSON")
+    ret['fabric'] = {
+        "argocd_admin_password": argocd_secret['password'],
+        "argocd_user_password": argocd_user_secret['password']
+    }
+
+    # fix issue with non existing server certificates file
+    ret["server_certificate"] = {
+        "ca_cert_file": "/root/rootCA.crt",
+        "tls_cert_file": "/root/server.crt",
+        "tls_key_file": "/root/server.key"
+    }
+
+    ret["identity_certificate"] = {
+        "token_signing_cert_file": "/root/token_signing_certificate.pfx",  # nosec
+        "token_signing_cert_pass": ''.join(random.choice(string.ascii_letters) for i in range(20)),  # nosec
+        "ldap_cert_authority_file": ""
+    }
+
+    ret['self_signed_cert_validity'] = properties['SelfSignedCertificateValidity']
+
+    ret["sql"] = {"create_db": True}
+    sql = {
+        'username': db_secret['username'],
+        'dot_net_escaped_password': db_secret['password'].replace("'", "''"),
+        'odbc_escaped_password': db_secret['password'].replace("}", "}}"),
+        'urlencoded_username': quote(db_secret['username'], safe=''),
+        'urlencoded_password': quote(db_secret['password'], safe='')
+    }
+
+    sql_pools = get_sql_pools(properties, enabled_services_map, multi_node, initial_number_of_instances)
+
+    print("Adding SQL connection strings to JSON")
+    ret["sql_connection_string_template"] = f"Server=tcp:{db_endpoint},1433;Initial Catalog=DB_NAME_PLACEHOLDER;Persist Security Info=False;User Id={sql['username']};Password='{sql['dot_net_escaped_password']}';MultipleActiveResultSets=False;Encrypt=True;TrustServerCertificate=True;Connection Timeout={SQL_CONNECTION_TIMEOUT};Max Pool Size={sql_pools['main']};"
+    ret["sql_connection_string_template_jdbc"] = f"jdbc:sqlserver://{db_endpoint}:1433;database=DB_NAME_PLACEHOLDER;user={sql['username']};password={{{sql['odbc_escaped_password']}}};encrypt=true;trustServerCertificate=true;Connection Timeout={SQL_CONNECTION_TIMEOUT};"
+    ret["sql_connection_string_template_odbc"] = f"SERVER={db_endpoint},1433;DATABASE=DB_NAME_PLACEHOLDER;DRIVER={{ODBC Driver 17 for SQL Server}};UID={sql['username']};PWD={{{sql['odbc_escaped_password']}}};MultipleActiveResultSets=False;Encrypt=YES;TrustServerCertificate=YES;Connection Timeout={SQL_CONNECTION_TIMEOUT};"
+    ret["sql_connection_string_template_sqlalchemy_pyodbc"] = f"mssql+pyodbc://{sql['urlencoded_username']}:{sql['urlencoded_password']}@{db_endpoint}:1433/DB_NAME_PLACEHOLDER?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=YES&Encrypt=YES"
+
+    context['sql'] = sql
+    context['sql_pools'] = sql_pools
+    for service in SERVICES:
+        enabled = enabled_services_map[service.name]
+        block = {'enabled': enabled}
+        if service.always_blocks:
+            block.update(service.always_blocks(context, enabled))
+        if enabled:
+            if service.bucket:
+                block['external_object_storage'] = {'bucket_name': get_service_bucket(service, properties)}
+            if service.blocks:
+                block.update(service.blocks(context))
+        ret[service.name] = block
+    ret['infra'] = {
+        "external_object_storage": {
+            "bucket_name": ret['platform']['external_object_storage']['bucket_name']
+        }
+    }
+
+    ret["initial_number_of_instances"] = initial_number_of_instances
+
+    for overlay in overlays or []:
+        ret = deep_merge(ret, overlay)
+    return ret
@@ -1,543 +1,373 @@
-import boto3
+import cfnruntime
 import json
 import cfnresponse
-import threading
-import uuid
-import random
-import string
 import base64
-from urllib.parse import quote
-
-AICENTER_EXTERNAL_IDENTITY_CERT_PATH = "/root/installer/identity.cer"
-AICENTER_EXTERNAL_ORCH_CERT_PATH = "/root/installer/orchestrator.cer"
-
-def get_enabled_services_map(properties):
-    enabled_services_map = {
-        'platform' : True,
-        'processmining': properties['ProcessMining'].lower() == "true",
-        'orchestrator' : properties['Orchestrator'].lower() == "true",
-        'action_center' : properties['ActionCenter'].lower() == "true",
-        'test_manager' : properties['TestManager'].lower() == "true",
-        'insights' : properties['Insights'].lower() == "true",
-        'dataservice' : properties['DataService'].lower() == "true",
-        'automation_hub' : properties['AutomationHub'].lower() == "true",
-        'automation_ops' : properties['AutomationOps'].lower() == "true",
-        'task_mining' : properties['TaskMining'].lower() == "true",
-        'aicenter' : properties['AiCenter'].lower() == "true",
-        'documentunderstanding' : properties['DocumentUnderstanding'].lower() == "true",
-        'apps' : properties['BusinessApps'].lower() == "true",
-        'asrobots' : properties['ASRobots'].lower() == "true"
-    }
-    print("Enabled services:")
-    for service, status in enabled_services_map.items():
-        print(f'{service} is enabled? {status}')
-    return enabled_services_map
-
-
-def check_certificate(service, base64_encoded_cert):
-    if not base64_encoded_cert:
-        print(f"{service} certificate not provided.")
-        raise Exception("Certificate missing")
+import gzip
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from input_json import render_input_json, validate_document
+
+# BatchGetSecretValue returns at most 20 secrets per call
+BATCH_GET_SECRETS_LIMIT = 20
+MAX_SECRET_READ_WORKERS = 5
+# Extra configuration objects downloaded from S3, kept with their ETag across warm invocations
+EXTRA_CONFIG_CACHE_DIR = '/tmp/extra-config'
+EXTRA_CONFIG_CHUNK_SIZE = 1024 * 1024
+MAX_EXTRA_CONFIG_DOWNLOAD_WORKERS = 4
+# Compressed input.json storage: a manifest in the target secret, holding the gzip+base64 payload
+# inline when it fits or the names of the secrets it is split across. Secret values are capped at 64 KiB.
+INPUT_JSON_STORAGE_MODES = ('plain', 'compressed')
+INPUT_JSON_MANIFEST_KEY = 'uipath_input_json'
+INPUT_JSON_MANIFEST_VERSION = 1
+INPUT_JSON_PART_SIZE = 60000
+# Fields generated anew on every run, which alone do not make the document different
+REGENERATED_FIELDS = [
+    ('rke_token',),
+    ('identity_certificate', 'token_signing_cert_pass')
+]
+
+# (bucket, key, etag) -> parsed document
+_extra_config_documents = {}
+
+
+def get_secretsmanager_client(region):
+    return cfnruntime.get_client('secretsmanager', region)
+
+
+def batch_get_secrets(sm, secret_ids: list) -> dict:
+    secret_strings = {}
+    for start in range(0, len(secret_ids), BATCH_GET_SECRETS_LIMIT):
+        batch = secret_ids[start:start + BATCH_GET_SECRETS_LIMIT]
+        response = sm.batch_get_secret_value(SecretIdList=batch)
+        if response.get('Errors'):
+            errors = "; ".join(f"{error['SecretId']}: {error['ErrorCode']}" for error in response['Errors'])
+            raise Exception(f"Failed to read secrets: {errors}")
+        for secret_value in response['SecretValues']:
+            for secret_id in batch:
+                if secret_id in (secret_value['ARN'], secret_value['Name']):
+                    secret_strings[secret_id] = secret_value['SecretString']
+    missing_ids = [secret_id for secret_id in secret_ids if secret_id not in secret_strings]
+    if missing_ids:
+        raise Exception(f"Secrets missing from the batch read: {missing_ids}")
+    return secret_strings
+
+
+def get_secrets(sm, secret_ids: list) -> dict:
+    """Read the JSON secrets in secret_ids together and return them parsed, keyed by secret id.
+
+    Uses BatchGetSecretValue when the SDK and the role allow it, concurrent GetSecretValue calls otherwise.
+    """
+    secret_ids = list(dict.fromkeys(secret_ids))
+    secret_strings = None
+    if hasattr(sm, 'batch_get_secret_value'):
+        try:
+            secret_strings = batch_get_secrets(sm, secret_ids)
+        except Exception as e:
+            if cfnruntime.get_error_code(e) != 'AccessDeniedException':
+                raise e
+            print("Not allowed to batch read secrets, reading them one by one")
+    if secret_strings is None:
+        with ThreadPoolExecutor(max_workers=min(len(secret_ids), MAX_SECRET_READ_WORKERS)) as executor:
+            responses = executor.map(lambda secret_id: sm.get_secret_value(SecretId=secret_id), secret_ids)
+            secret_strings = {secret_id: response['SecretString'] for secret_id, response in zip(secret_ids, responses)}
+    return {secret_id: json.loads(secret_string) for secret_id, secret_string in secret_strings.items()}
+
+
+def get_secret_string(sm, secret_id):
+    """Current value of secret_id, None when the secret or its current value does not exist."""
     try:
-        base64.b64decode(base64_encoded_cert, validate=True)
+        return sm.get_secret_value(SecretId=secret_id)['SecretString']
     except Exception as e:
-        print("Failed to decode base64 certificate provided")
-        raise e
+        if cfnruntime.get_error_code(e) != 'ResourceNotFoundException':
+            raise e
+        return None
 
-def check_ai_center_external_certificates(properties: dict):
-    check_certificate("Orchestrator", properties['OrchestratorCertificate'])
-    check_certificate("Identity", properties['IdentityCertificate'])
 
+def get_canonical_content(document) -> str:
+    canonical = json.loads(json.dumps(document))
+    for path in REGENERATED_FIELDS:
+        parent = canonical
+        for key in path[:-1]:
+            parent = parent.get(key) if isinstance(parent, dict) else None
+        if isinstance(parent, dict):
+            parent.pop(path[-1], None)
+    return json.dumps(canonical, sort_keys=True, separators=(',', ':'))
 
-def create(properties, physical_id):
-    region = properties["RegionName"]
-    aws_url_suffix = properties["AwsUrlSuffix"]
-    secret_arn = properties["TargetSecretArn"]
-    db_password_secret_arn = properties["RDSPasswordSecretArn"]
-    platform_secret_arn = properties['PlatformSecretArn']
-    org_secret_arn = properties['OrgSecretArn']
-    argocd_secret_arn = properties['ArgoCdSecretArn']
-    argocd_user_secret_arn = properties['ArgoCdUserSecretArn']
-    fqdn = properties["Fqdn"]
-    db_endpoint = properties["RDSDBInstanceEndpointAddress"]
-    pm_db_endpoint = properties["PMRDSDBInstanceEndpointAddress"]
-    multi_node = properties["MultiNode"]
-    internal_load_balancer_dns = properties["KubeLoadBalancerDns"]
-    add_gpu = properties['AddGpu']
-    server_instance_count = int(properties['ServerInstanceCount'])
-    agent_instance_count = int(properties['AgentInstanceCount'])
-    private_subnet_ids = properties['PrivateSubnetIDs']
-    extra_dict_keys = properties['ExtraConfigKeys']
-    self_signed_cert_validity = properties['SelfSignedCertificateValidity']
-    shared_bucket = properties['SharedStorageBucket']
-    using_shared_bucket = (shared_bucket != '')
-    platform_bucket = shared_bucket if using_shared_bucket else properties['PlatformStorageBucket']
-    orchestrator_bucket = shared_bucket if using_shared_bucket else properties['OrchestratorStorageBucket']
-    apps_bucket = shared_bucket if using_shared_bucket else properties['AppsStorageBucket']
-    test_manager_bucket = shared_bucket if using_shared_bucket else properties['TestManagerStorageBucket']
-    ai_center_bucket = shared_bucket if using_shared_bucket else properties['AiCenterStorageBucket']
-    du_bucket = shared_bucket if using_shared_bucket else properties['DocumentUnderstandingStorageBucket']
-    task_mining_bucket = shared_bucket if using_shared_bucket else properties['TaskMiningStorageBucket']
-    data_service_bucket = properties['DataServiceStorageBucket']
-    process_mining_bucket = properties['ProcessMiningStorageBucket']
-    use_external_orchestrator = properties['UseExternalOrchestrator']
-    orchestrator_url = properties['OrchestratorURL']
-    identity_url = properties['IdentityURL']
-    initial_number_of_instances = server_instance_count + agent_instance_count
-
-    enabled_services_map = get_enabled_services_map(properties)
-    if use_external_orchestrator.lower() == "true":
-        check_ai_center_external_certificates(properties)
-
-    ret = {"fqdn": fqdn, "rke_token": str(uuid.uuid4())}
-    ret['cloud_template_vendor'] = 'AWS'
-    ret['cloud_template_source'] = 'Quickstart'
-
-    ret['external_object_storage'] = {
-        'enabled': True,
-        'create_bucket': False,
-        'storage_type': 's3',
-        'region': region,
-        'use_instance_profile': True,
-        'port': 443,
-        'fqdn': f's3.{region}.{aws_url_suffix}'
-    }
 
-    ret['fixed_rke_address'] = internal_load_balancer_dns
-    if multi_node.lower() == 'multi node':
-        ret['profile'] = 'ha'
-        subnet_list = private_subnet_ids.split(',')
-        if len(subnet_list) >= 3:
-            ret['zone_resilience'] = True
-        else:
-            ret['zone_resilience'] = False
-    else:
-        ret['profile'] = 'default'
+def get_input_json_manifest(secret_string) -> dict:
+    """The input.json manifest held in secret_string, None for plain JSON or a missing value."""
+    try:
+        current = json.loads(secret_string) if secret_string else None
+    except Exception:
+        return None
+    manifest = current.get(INPUT_JSON_MANIFEST_KEY) if isinstance(current, dict) else None
+    return manifest if isinstance(manifest, dict) else None
 
-    if add_gpu.lower() == 'true':
-        initial_number_of_instances += 1
 
-    sm = boto3.client('secretsmanager', region_name=region)
+def load_secret_document(sm, secret_string):
+    """The document stored in secret_string and its storage, (None, None) when it cannot be read.
 
-    print("Getting Platform secret")
-    db_secret = sm.get_secret_value(
-        SecretId=platform_secret_arn
+    A compressed manifest is decoded, reading its part secrets when it was split.
+    """
+    if secret_string is None:
+        return None, None
+    manifest = get_input_json_manifest(secret_string)
+    try:
+        if manifest is None:
+            return json.loads(secret_string), 'plain'
+        if 'data' in manifest:
+            payload = manifest['data']
+        else:
+            parts = [get_secret_string(sm, name) for name in manifest.get('parts', [])]
+            if None in parts:
+                return None, None
+            payload = ''.join(parts)
+        compressed = base64.b64decode(payload)
+        if hashlib.sha256(compressed).hexdigest() != manifest.get('sha256'):
+            return None, None
+        return json.loads(gzip.decompress(compressed)), 'compressed'
+    except Exception as e:
+        print(f"Failed to read the current secret value: {e}")
+        return None, None
+
+
+def put_secret_if_changed(sm, secret_id, document: dict, storage: str = 'plain', serialize=None) -> bool:
+    """Store document as the new secret version unless the current version already holds the same content.
+
+    The documents hold credentials, so no hash of them is kept anywhere: the current value is read
+    back and compared with document. serialize, called with the current secret string only when a
+    write is needed, returns the new secret string; it defaults to plain JSON.
+    """
+    current_string = get_secret_string(sm, secret_id)
+    current_document, current_storage = load_secret_document(sm, current_string)
+    if current_storage == storage and get_canonical_content(current_document) == get_canonical_content(document):
+        print(f"Secret {secret_id} is up to date, skipping the write")
+        return False
+
+    response = sm.put_secret_value(
+        SecretId=secret_id,
+        SecretString=serialize(current_string) if serialize else json.dumps(document)
     )
-    secret = json.loads(db_secret['SecretString'])
-    print("Adding Platform username and password to JSON")
-    ret["admin_username"] = secret['username']
-    ret["admin_password"] = secret['password']
+    print(f"Wrote secret {secret_id} version {response['VersionId']}")
+    return True
 
-    print("Adding the org secret")
-    sm.put_secret_value(
-        SecretId=org_secret_arn,
-        SecretString=json.dumps({"username": "orgadmin", "password": secret['password']})
-    )
 
-    print("Getting ArgoCD secret")
-    argocd_secret = sm.get_secret_value(
-        SecretId=argocd_secret_arn
-    )
-    secret = json.loads(argocd_secret['SecretString'])
-    print("Adding ArgoCD username and password to JSON")
-    ret['fabric'] = {"argocd_admin_password": secret['password']}
+def get_input_json_parts(sm, secret_id) -> list:
+    """Names of the part secrets the current input.json manifest in secret_id points to or kept from the previous one."""
+    manifest = get_input_json_manifest(get_secret_string(sm, secret_id))
+    return manifest.get('parts', []) + manifest.get('previous_parts', []) if manifest else []
 
-    print("Getting ArgoCD readonly User secret")
-    argocd_user_secret = sm.get_secret_value(
-        SecretId=argocd_user_secret_arn
-    )
-    secret = json.loads(argocd_user_secret['SecretString'])
-    print("Adding ArgoCD readonly user's password to JSON")
-    ret['fabric']["argocd_user_password"] = secret['password']
 
-    # fix issue with non existing server certificates file
-    ret["server_certificate"] = {}
-    ret["server_certificate"]["ca_cert_file"] = "/root/rootCA.crt"
-    ret["server_certificate"]["tls_cert_file"] = "/root/server.crt"
-    ret["server_certificate"]["tls_key_file"] = "/root/server.key"
+def get_part_secret_settings(sm, secret_id) -> dict:
+    """create_secret arguments giving the part secrets the KMS key and the tags of the target secret secret_id."""
+    description = sm.describe_secret(SecretId=secret_id)
+    settings = {}
+    if description.get('KmsKeyId'):
+        settings['KmsKeyId'] = description['KmsKeyId']
+    # the aws: prefixed tags, set by CloudFormation for instance, are reserved
+    tags = [tag for tag in description.get('Tags', []) if not tag['Key'].startswith('aws:')]
+    if tags:
+        settings['Tags'] = tags
+    return settings
+
 
-    ret["identity_certificate"] = {}
-    ret["identity_certificate"]["token_signing_cert_file"] = "/root/token_signing_certificate.pfx"  # nosec
-    ret["identity_certificate"]["token_signing_cert_pass"] = ''.join(random.choice(string.ascii_letters) for i in range(20))  # nosec
-    ret["identity_certificate"]["ldap_cert_authority_file"] = ""
+def create_part_secret(sm, name: str, value: str, settings: dict):
+    sm.create_secret(Name=name, Description='Part of the compressed input json file of the deployment',
+                     SecretString=value, **settings)
 
-    ret['self_signed_cert_validity'] = self_signed_cert_validity
 
+def delete_part_secrets(sm, names: list):
+    for name in names:
+        print(f"Deleting input json part {name}")
+        try:
+            sm.delete_secret(SecretId=name, ForceDeleteWithoutRecovery=True)
+        except Exception as e:
+            if cfnruntime.get_error_code(e) != 'ResourceNotFoundException':
+                raise e
+
+
+def serialize_compressed(sm, secret_id, part_prefix: str, document: dict) -> dict:
+    """Manifest of document gzip compressed, writing the part secrets first when it has to be split.
+
+    Every write uses new part names, so a manifest only ever points to complete parts. The parts are
+    encrypted with the KMS key and carry the tags of the target secret secret_id.
+    """
+    compressed = gzip.compress(json.dumps(document).encode('utf-8'), mtime=0)
+    payload = base64.b64encode(compressed).decode('ascii')
+    manifest = {
+        'version': INPUT_JSON_MANIFEST_VERSION,
+        'encoding': 'gzip+base64',
+        'sha256': hashlib.sha256(compressed).hexdigest()
+    }
+    if len(payload) <= INPUT_JSON_PART_SIZE:
+        manifest['data'] = payload
+    else:
+        manifest['parts'] = []
+        part_id = uuid.uuid4().hex[:16]
+        settings = get_part_secret_settings(sm, secret_id)
+        for start in range(0, len(payload), INPUT_JSON_PART_SIZE):
+            name = f"{part_prefix}{part_id}-{start // INPUT_JSON_PART_SIZE + 1}"
+            create_part_secret(sm, name, payload[start:start + INPUT_JSON_PART_SIZE], settings)
+            manifest['parts'].append(name)
+    print(f"Compressed input json from {len(json.dumps(document))} to {len(payload)} characters "
+          f"in {len(manifest.get('parts', [])) or 'no'} part secrets")
+    return manifest
+
+
+def put_input_json(sm, properties: dict, document: dict):
+    """Write document to the target secret as plain JSON or as a compressed manifest, per InputJsonStorage.
+
+    Nodes may still be downloading the parts of the manifest being replaced, so the new manifest keeps
+    them as its previous parts and they are only deleted by the next write. Switching to plain storage
+    deletes them right away, a plain document has nowhere to record them.
+    """
+    secret_arn = properties["TargetSecretArn"]
+    storage = properties.get('InputJsonStorage') or 'plain'
+    if storage not in INPUT_JSON_STORAGE_MODES:
+        raise Exception(f"Unknown input json storage {storage}")
+    expired_parts = []
+
+    def serialize(current_string) -> str:
+        current_manifest = get_input_json_manifest(current_string) or {}
+        expired_parts.extend(current_manifest.get('previous_parts', []))
+        if storage == 'plain':
+            expired_parts.extend(current_manifest.get('parts', []))
+            return json.dumps(document)
+        manifest = serialize_compressed(sm, secret_arn, properties['InputJsonPartPrefix'], document)
+        if current_manifest.get('parts'):
+            manifest['previous_parts'] = current_manifest['parts']
+        return json.dumps({INPUT_JSON_MANIFEST_KEY: manifest})
+
+    if put_secret_if_changed(sm, secret_arn, document, storage, serialize):
+        delete_part_secrets(sm, expired_parts)
+
+
+def get_s3_client(region):
+    return cfnruntime.get_client('s3', region)
+
+
+def get_s3_extra_config(s3, bucket: str, key: str) -> dict:
+    """Parsed JSON object s3://bucket/key, downloaded again only when its ETag changed."""
+    cache_path = os.path.join(EXTRA_CONFIG_CACHE_DIR, hashlib.sha256(f"{bucket}/{key}".encode('utf-8')).hexdigest())
+    cached_etag = None
+    if os.path.exists(cache_path + '.etag') and os.path.exists(cache_path + '.json'):
+        with open(cache_path + '.etag') as etag_file:
+            cached_etag = etag_file.read()
+
+    try:
+        if cached_etag:
+            response = s3.get_object(Bucket=bucket, Key=key, IfNoneMatch=cached_etag)
+        else:
+            response = s3.get_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        if cfnruntime.get_error_code(e) not in ('304', 'NotModified'):
+            raise e
+        print(f"Using cached extra configuration s3://{bucket}/{key} ({cached_etag})")
+        etag = cached_etag
+    else:
+        etag = response['ETag']
+        print(f"Downloading extra configuration s3://{bucket}/{key} ({etag})")
+        os.makedirs(EXTRA_CONFIG_CACHE_DIR, exist_ok=True)
+        with open(cache_path + '.download', 'wb') as download_file:
+            for chunk in response['Body'].iter_chunks(EXTRA_CONFIG_CHUNK_SIZE):
+                download_file.write(chunk)
+        os.replace(cache_path + '.download', cache_path + '.json')
+        with open(cache_path + '.etag', 'w') as etag_file:
+            etag_file.write(etag)
+
+    if (bucket, key, etag) not in _extra_config_documents:
+        with open(cache_path + '.json') as document_file:
+            try:
+                _extra_config_documents[(bucket, key, etag)] = json.load(document_file)
+            except Exception as e:
+                print(f"Failed to load the extra configuration s3://{bucket}/{key}")
+                raise e
+    return _extra_config_documents[(bucket, key, etag)]
+
+
+def get_extra_configs(properties: dict) -> list:
+    """Extra configuration overlays in precedence order: the S3 objects as listed, then ExtraConfigKeys."""
+    overlays = []
+    bucket = properties.get('ExtraConfigS3Bucket', '')
+    keys = [key.strip() for key in properties.get('ExtraConfigS3Keys', '').split(',') if key.strip()]
+    if bucket and keys:
+        s3 = get_s3_client(properties["RegionName"])
+        with ThreadPoolExecutor(max_workers=min(len(keys), MAX_EXTRA_CONFIG_DOWNLOAD_WORKERS)) as executor:
+            overlays.extend(executor.map(lambda key: get_s3_extra_config(s3, bucket, key), keys))
+
+    extra_dict_keys = properties['ExtraConfigKeys']
     if extra_dict_keys:
         try:
             extra_dict_json = json.loads(extra_dict_keys)
-            print(json.dumps(extra_dict_json))
+            # the values may hold registry credentials
+            print(f"Extra configuration keys: {sorted(extra_dict_json)}")
         except Exception as e:
             print("Failed to load the extra configuration dictionary")
             raise e
+        overlays.append(extra_dict_json)
 
-        if extra_dict_json:
-            ret.update(extra_dict_json)
+    for position, overlay in enumerate(overlays):
+        if not isinstance(overlay, dict):
+            raise Exception(f"Extra configuration #{position + 1} is not a JSON object")
+    return overlays
 
-    print("Getting RDS secret")
-    db_secret = sm.get_secret_value(
-        SecretId=db_password_secret_arn
-    )
-    secret = json.loads(db_secret['SecretString'])
-    ret["sql"] = {}
-    ret["sql"]["create_db"] = True
-
-    dot_net_escaped_password = secret['password'].replace("'", "''")
-    odbc_escaped_password = secret['password'].replace("}", "}}")
-    urlencoded_pyodbc_username = quote(secret['username'], safe='')
-    urlencoded_pyodbc_password = quote(secret['password'], safe='')
-
-    print("Adding SQL connection strings to JSON")
-    ret["sql_connection_string_template"] = f"Server=tcp:{db_endpoint},1433;Initial Catalog=DB_NAME_PLACEHOLDER;Persist Security Info=False;User Id={secret['username']};Password='{dot_net_escaped_password}';MultipleActiveResultSets=False;Encrypt=True;TrustServerCertificate=True;Connection Timeout=30;Max Pool Size=100;"
-    ret["sql_connection_string_template_jdbc"] = f"jdbc:sqlserver://{db_endpoint}:1433;database=DB_NAME_PLACEHOLDER;user={secret['username']};password={{{odbc_escaped_password}}};encrypt=true;trustServerCertificate=true;Connection Timeout=30;"
-    ret["sql_connection_string_template_odbc"] = f"SERVER={db_endpoint},1433;DATABASE=DB_NAME_PLACEHOLDER;DRIVER={{ODBC Driver 17 for SQL Server}};UID={secret['username']};PWD={{{odbc_escaped_password}}};MultipleActiveResultSets=False;Encrypt=YES;TrustServerCertificate=YES;Connection Timeout=30;"
-    ret["sql_connection_string_template_sqlalchemy_pyodbc"] = f"mssql+pyodbc://{urlencoded_pyodbc_username}:{urlencoded_pyodbc_password}@{db_endpoint}:1433/DB_NAME_PLACEHOLDER?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=YES&Encrypt=YES"
-
-    ret['platform'] = {}
-    ret['platform']['enabled'] = enabled_services_map['platform']
-    ret['platform']['external_object_storage'] = {'bucket_name': platform_bucket}
-    ret['infra'] = {
-        "external_object_storage": {
-            "bucket_name": platform_bucket
-        }
-    }
 
-    ret['orchestrator'] = {}
-    ret['orchestrator']['enabled'] = enabled_services_map['orchestrator']
-    ret['orchestrator']['testautomation'] = {"enabled": enabled_services_map['orchestrator']}
-    ret['orchestrator']['updateserver'] = {"enabled": enabled_services_map['orchestrator']}
-    if enabled_services_map['orchestrator']:
-        ret['orchestrator']['external_object_storage'] = {'bucket_name': orchestrator_bucket}
-
-    ret['automation_hub'] = {"enabled": enabled_services_map['automation_hub']}
-
-    ret['automation_ops'] = {"enabled": enabled_services_map['automation_ops']}
-
-    ret['action_center'] =  {"enabled":enabled_services_map['action_center']}
-
-    ret['dataservice'] = {"enabled": enabled_services_map['dataservice']}
-    if enabled_services_map['dataservice']:
-        ret['dataservice']['external_object_storage'] = {'bucket_name': data_service_bucket}
-
-    ret['test_manager'] = {"enabled": enabled_services_map['test_manager']}
-    if enabled_services_map['test_manager']:
-        ret['test_manager']['external_object_storage'] = {'bucket_name': test_manager_bucket}
-
-    ret['insights'] = {"enabled": enabled_services_map['test_manager']}
-
-    ret['apps'] = {"enabled": enabled_services_map['apps']}
-    if enabled_services_map['apps']:
-        ret['apps']['external_object_storage'] = {'bucket_name': apps_bucket}
-
-    ret['task_mining'] = {"enabled": enabled_services_map['task_mining']}
-    if enabled_services_map['task_mining']:
-        ret['task_mining']['external_object_storage'] = {'bucket_name': task_mining_bucket}
-        initial_number_of_instances += 1
-
-    ret['processmining'] = {"enabled": enabled_services_map['processmining']}
-    if enabled_services_map['processmining']:
-        ret['processmining']['external_object_storage'] = {'bucket_name': process_mining_bucket}
-        if pm_db_endpoint:
-            ret['processmining']["warehouse"] = {
-                "sql_connection_str": f"Server=tcp:{pm_db_endpoint},1433;Initial Catalog=DB_NAME_PLACEHOLDER;Persist Security Info=False;User Id={secret['username']};Password='{dot_net_escaped_password}';MultipleActiveResultSets=False;Encrypt=True;TrustServerCertificate=True;Connection Timeout=30;Max Pool Size=100;",
-                "sqlalchemy_pyodbc_sql_connection_str": f"mssql+pyodbc://{urlencoded_pyodbc_username}:{urlencoded_pyodbc_password}@{pm_db_endpoint}:1433/DB_NAME_PLACEHOLDER?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=YES&Encrypt=YES"
-            }
-
-    ret['aicenter'] = {"enabled": enabled_services_map['aicenter']}
-    if enabled_services_map['aicenter']:
-        ret['aicenter']['external_object_storage'] = {'bucket_name': ai_center_bucket}
-        if use_external_orchestrator.lower() == "true":
-            ret['aicenter']["orchestrator_url"] = orchestrator_url
-            ret['aicenter']["identity_server_url"] = identity_url
-            ret['aicenter']["orchestrator_cert_file_path"] = AICENTER_EXTERNAL_ORCH_CERT_PATH
-            ret['aicenter']["identity_cert_file_path"] = AICENTER_EXTERNAL_IDENTITY_CERT_PATH
-            ret['aicenter']["metering_api_key"] = "PLACEHOLDER"
-
-    ret['documentunderstanding'] = {}
-    ret['documentunderstanding']['enabled'] = enabled_services_map['documentunderstanding']
-    if enabled_services_map['documentunderstanding']:
-        ret['documentunderstanding']['handwriting'] = {
-            "enabled": True,
-            "max_cpu_per_pod": 2
-        }
-        ret['documentunderstanding']['external_object_storage'] = {'bucket_name': du_bucket}
-
-    ret['asrobots'] = {'enabled': enabled_services_map['asrobots']}
-    if enabled_services_map['asrobots']:
-        ret['asrobots']["packagecaching"] = True
-        if multi_node.lower() == 'multi node':
-            initial_number_of_instances += 1
-
-    ret["initial_number_of_instances"] = initial_number_of_instances
-
-    sm.put_secret_value(
-        SecretId=secret_arn,
-        SecretString=json.dumps(ret)
-    )
-    return_attribute = dict()
-    return_attribute['Action'] = 'CREATE'
-    return cfnresponse.SUCCESS, secret_arn, return_attribute
-
-
-def update(properties, physical_id):
+def write_input_json(properties):
     region = properties["RegionName"]
-    aws_url_suffix = properties["AwsUrlSuffix"]
     secret_arn = properties["TargetSecretArn"]
     db_password_secret_arn = properties["RDSPasswordSecretArn"]
     platform_secret_arn = properties['PlatformSecretArn']
     org_secret_arn = properties['OrgSecretArn']
     argocd_secret_arn = properties['ArgoCdSecretArn']
     argocd_user_secret_arn = properties['ArgoCdUserSecretArn']
-    fqdn = properties["Fqdn"]
-    db_endpoint = properties["RDSDBInstanceEndpointAddress"]
-    pm_db_endpoint = properties["PMRDSDBInstanceEndpointAddress"]
-    multi_node = properties["MultiNode"]
-    internal_load_balancer_dns = properties["KubeLoadBalancerDns"]
-    add_gpu = properties['AddGpu']
-    server_instance_count = int(properties['ServerInstanceCount'])
-    agent_instance_count = int(properties['AgentInstanceCount'])
-    private_subnet_ids = properties['PrivateSubnetIDs']
-    extra_dict_keys = properties['ExtraConfigKeys']
-    self_signed_cert_validity = properties['SelfSignedCertificateValidity']
-    shared_bucket = properties['SharedStorageBucket']
-    using_shared_bucket = (shared_bucket != '')
-    platform_bucket = shared_bucket if using_shared_bucket else properties['PlatformStorageBucket']
-    orchestrator_bucket = shared_bucket if using_shared_bucket else properties['OrchestratorStorageBucket']
-    apps_bucket = shared_bucket if using_shared_bucket else properties['AppsStorageBucket']
-    test_manager_bucket = shared_bucket if using_shared_bucket else properties['TestManagerStorageBucket']
-    ai_center_bucket = shared_bucket if using_shared_bucket else properties['AiCenterStorageBucket']
-    du_bucket = shared_bucket if using_shared_bucket else properties['DocumentUnderstandingStorageBucket']
-    task_mining_bucket = shared_bucket if using_shared_bucket else properties['TaskMiningStorageBucket']
-    data_service_bucket = properties['DataServiceStorageBucket']
-    process_mining_bucket = properties['ProcessMiningStorageBucket']
-    use_external_orchestrator = properties['UseExternalOrchestrator']
-    orchestrator_url = properties['OrchestratorURL']
-    identity_url = properties['IdentityURL']
-    initial_number_of_instances = server_instance_count + agent_instance_count
-
-    enabled_services_map = get_enabled_services_map(properties)
-    if use_external_orchestrator.lower() == "true":
-        check_ai_center_external_certificates(properties)
-
-    ret = {"fqdn": fqdn, "rke_token": str(uuid.uuid4())}
-    ret['cloud_template_vendor'] = 'AWS'
-    ret['cloud_template_source'] = 'Quickstart'
-
-    ret['external_object_storage'] = {
-        'enabled': True,
-        'create_bucket': False,
-        'storage_type': 's3',
-        'region': region,
-        'use_instance_profile': True,
-        'port': 443,
-        'fqdn': f's3.{region}.{aws_url_suffix}'
-    }
-    
-    ret['fixed_rke_address'] = internal_load_balancer_dns
-    if multi_node.lower() == 'multi node':
-        ret['profile'] = 'ha'
-        subnet_list = private_subnet_ids.split(',')
-        if len(subnet_list) >= 3:
-            ret['zone_resilience'] = True
-        else:
-            ret['zone_resilience'] = False
-    else:
-        ret['profile'] = 'default'
-
-    if add_gpu.lower() == 'true':
-        initial_number_of_instances += 1
 
-    sm = boto3.client('secretsmanager', region_name=region)
-
-    print("Getting Platform secret")
-    db_secret = sm.get_secret_value(
-        SecretId=platform_secret_arn
+    sm = get_secretsmanager_client(region)
+
+    print("Getting Platform, ArgoCD, ArgoCD readonly User and RDS secrets")
+    secrets = get_secrets(sm, [platform_secret_arn, argocd_secret_arn, argocd_user_secret_arn, db_password_secret_arn])
+    ret = render_input_json(
+        properties,
+        platform_secret=secrets[platform_secret_arn],
+        argocd_secret=secrets[argocd_secret_arn],
+        argocd_user_secret=secrets[argocd_user_secret_arn],
+        db_secret=secrets[db_password_secret_arn],
+        overlays=get_extra_configs(properties)
     )
-    secret = json.loads(db_secret['SecretString'])
-    print("Adding Platform username and password to JSON")
-    ret["admin_username"] = secret['username']
-    ret["admin_password"] = secret['password']
+    validate_document(ret)
 
     print("Adding the org secret")
-    sm.put_secret_value(
-        SecretId=org_secret_arn,
-        SecretString=json.dumps({"username": "orgadmin", "password": secret['password']})
-    )
-
-    print("Getting ArgoCD secret")
-    argocd_secret = sm.get_secret_value(
-        SecretId=argocd_secret_arn
-    )
-    secret = json.loads(argocd_secret['SecretString'])
-    print("Adding ArgoCD username and password to JSON")
-    ret['fabric'] = {"argocd_admin_password": secret['password']}
-
-    print("Getting ArgoCD readonly User secret")
-    argocd_user_secret = sm.get_secret_value(
-        SecretId=argocd_user_secret_arn
-    )
-    secret = json.loads(argocd_user_secret['SecretString'])
-    print("Adding ArgoCD readonly user's password to JSON")
-    ret['fabric']["argocd_user_password"] = secret['password']
-
-    # fix issue with non existing server certificates file
-    ret["server_certificate"] = {}
-    ret["server_certificate"]["ca_cert_file"] = "/root/rootCA.crt"
-    ret["server_certificate"]["tls_cert_file"] = "/root/server.crt"
-    ret["server_certificate"]["tls_key_file"] = "/root/server.key"
+    put_secret_if_changed(sm, org_secret_arn, {"username": "orgadmin", "password": secrets[platform_secret_arn]['password']})
+    put_input_json(sm, properties, ret)
+    return secret_arn
 
-    ret["identity_certificate"] = {}
-    ret["identity_certificate"]["token_signing_cert_file"] = "/root/token_signing_certificate.pfx"  # nosec
-    ret["identity_certificate"]["token_signing_cert_pass"] = ''.join(random.choice(string.ascii_letters) for i in range(20))  # nosec
-    ret["identity_certificate"]["ldap_cert_authority_file"] = ""
 
-    ret['self_signed_cert_validity'] = self_signed_cert_validity
-
-    if extra_dict_keys:
-        try:
-            extra_dict_json = json.loads(extra_dict_keys)
-            print(json.dumps(extra_dict_json))
-        except Exception as e:
-            print("Failed to load the extra configuration dictionary")
-            raise e
-
-        if extra_dict_json:
-            ret.update(extra_dict_json)
+def create(properties, physical_id):
+    secret_arn = write_input_json(properties)
+    return_attribute = dict()
+    return_attribute['Action'] = 'CREATE'
+    return cfnresponse.SUCCESS, secret_arn, return_attribute
 
-    print("Getting RDS secret")
-    db_secret = sm.get_secret_value(
-        SecretId=db_password_secret_arn
-    )
-    secret = json.loads(db_secret['SecretString'])
-    ret["sql"] = {}
-    ret["sql"]["create_db"] = True
-
-    dot_net_escaped_password = secret['password'].replace("'", "''")
-    odbc_escaped_password = secret['password'].replace("}", "}}")
-    urlencoded_pyodbc_username = quote(secret['username'], safe='')
-    urlencoded_pyodbc_password = quote(secret['password'], safe='')
-
-    print("Adding SQL connection strings to JSON")
-    ret["sql_connection_string_template"] = f"Server=tcp:{db_endpoint},1433;Initial Catalog=DB_NAME_PLACEHOLDER;Persist Security Info=False;User Id={secret['username']};Password='{dot_net_escaped_password}';MultipleActiveResultSets=False;Encrypt=True;TrustServerCertificate=True;Connection Timeout=30;Max Pool Size=100;"
-    ret["sql_connection_string_template_jdbc"] = f"jdbc:sqlserver://{db_endpoint}:1433;database=DB_NAME_PLACEHOLDER;user={secret['username']};password={{{odbc_escaped_password}}};encrypt=true;trustServerCertificate=true;Connection Timeout=30;"
-    ret["sql_connection_string_template_odbc"] = f"SERVER={db_endpoint},1433;DATABASE=DB_NAME_PLACEHOLDER;DRIVER={{ODBC Driver 17 for SQL Server}};UID={secret['username']};PWD={{{odbc_escaped_password}}};MultipleActiveResultSets=False;Encrypt=YES;TrustServerCertificate=YES;Connection Timeout=30;"
-    ret["sql_connection_string_template_sqlalchemy_pyodbc"] = f"mssql+pyodbc://{urlencoded_pyodbc_username}:{urlencoded_pyodbc_password}@{db_endpoint}:1433/DB_NAME_PLACEHOLDER?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=YES&Encrypt=YES"
-
-    ret['platform'] = {}
-    ret['platform']['enabled'] = enabled_services_map['platform']
-    ret['platform']['external_object_storage'] = {'bucket_name': platform_bucket}
-    ret['infra'] = {
-        "external_object_storage": {
-            "bucket_name": platform_bucket
-        }
-    }
 
-    ret['orchestrator'] = {}
-    ret['orchestrator']['enabled'] = enabled_services_map['orchestrator']
-    ret['orchestrator']['testautomation'] = {"enabled": enabled_services_map['orchestrator']}
-    ret['orchestrator']['updateserver'] = {"enabled": enabled_services_map['orchestrator']}
-    if enabled_services_map['orchestrator']:
-        ret['orchestrator']['external_object_storage'] = {'bucket_name': orchestrator_bucket}
-
-    ret['automation_hub'] = {"enabled": enabled_services_map['automation_hub']}
-
-    ret['automation_ops'] = {"enabled": enabled_services_map['automation_ops']}
-
-    ret['action_center'] =  {"enabled":enabled_services_map['action_center']}
-
-    ret['dataservice'] = {"enabled": enabled_services_map['dataservice']}
-    if enabled_services_map['dataservice']:
-        ret['dataservice']['external_object_storage'] = {'bucket_name': data_service_bucket}
-
-    ret['test_manager'] = {"enabled": enabled_services_map['test_manager']}
-    if enabled_services_map['test_manager']:
-        ret['test_manager']['external_object_storage'] = {'bucket_name': test_manager_bucket}
-
-    ret['insights'] = {"enabled": enabled_services_map['test_manager']}
-
-    ret['apps'] = {"enabled": enabled_services_map['apps']}
-    if enabled_services_map['apps']:
-        ret['apps']['external_object_storage'] = {'bucket_name': apps_bucket}
-
-    ret['task_mining'] = {"enabled": enabled_services_map['task_mining']}
-    if enabled_services_map['task_mining']:
-        ret['task_mining']['external_object_storage'] = {'bucket_name': task_mining_bucket}
-        initial_number_of_instances += 1
-
-    ret['processmining'] = {"enabled": enabled_services_map['processmining']}
-    if enabled_services_map['processmining']:
-        ret['processmining']['external_object_storage'] = {'bucket_name': process_mining_bucket}
-        if pm_db_endpoint:
-            ret['processmining']["warehouse"] = {
-                "sql_connection_str": f"Server=tcp:{pm_db_endpoint},1433;Initial Catalog=DB_NAME_PLACEHOLDER;Persist Security Info=False;User Id={secret['username']};Password='{dot_net_escaped_password}';MultipleActiveResultSets=False;Encrypt=True;TrustServerCertificate=True;Connection Timeout=30;Max Pool Size=100;",
-                "sqlalchemy_pyodbc_sql_connection_str": f"mssql+pyodbc://{urlencoded_pyodbc_username}:{urlencoded_pyodbc_password}@{pm_db_endpoint}:1433/DB_NAME_PLACEHOLDER?driver=ODBC+Driver+17+for+SQL+Server&TrustServerCertificate=YES&Encrypt=YES"
-            }
-
-    ret['aicenter'] = {"enabled": enabled_services_map['aicenter']}
-    if enabled_services_map['aicenter']:
-        ret['aicenter']['external_object_storage'] = {'bucket_name': ai_center_bucket}
-        if use_external_orchestrator.lower() == "true":
-            ret['aicenter']["orchestrator_url"] = orchestrator_url
-            ret['aicenter']["identity_server_url"] = identity_url
-            ret['aicenter']["orchestrator_cert_file_path"] = AICENTER_EXTERNAL_ORCH_CERT_PATH
-            ret['aicenter']["identity_cert_file_path"] = AICENTER_EXTERNAL_IDENTITY_CERT_PATH
-            ret['aicenter']["metering_api_key"] = "PLACEHOLDER"
-    
-    ret['documentunderstanding'] = {}
-    ret['documentunderstanding']['enabled'] = enabled_services_map['documentunderstanding']
-    if enabled_services_map['documentunderstanding']:
-        ret['documentunderstanding']['handwriting'] = {
-            "enabled": True,
-            "max_cpu_per_pod": 2
-        }
-        ret['documentunderstanding']['external_object_storage'] = {'bucket_name': du_bucket}
-
-    ret['asrobots'] = {'enabled': enabled_services_map['asrobots']}
-    if enabled_services_map['asrobots']:
-        ret['asrobots']["packagecaching"] = True
-        if multi_node.lower() == 'multi node':
-            initial_number_of_instances += 1
-
-    ret["initial_number_of_instances"] = initial_number_of_instances
-
-    sm.put_secret_value(
-        SecretId=secret_arn,
-        SecretString=json.dumps(ret)
-    )
+def update(properties, physical_id):
+    write_input_json(properties)
     return_attribute = dict()
     return_attribute['Action'] = 'UPDATE'
     return cfnresponse.SUCCESS, physical_id, return_attribute
 
 
 def delete(properties, physical_id):
+    # the input json secret itself belongs to the stack, only the part secrets are created here
+    sm = get_secretsmanager_client(properties["RegionName"])
+    delete_part_secrets(sm, get_input_json_parts(sm, properties["TargetSecretArn"]))
     return_attribute = {'Action': 'DELETE'}
     return cfnresponse.SUCCESS, physical_id, return_attribute
 
 
-def timeout(event, context):
-    print('Execution is about to time out, sending failure response to CloudFormation')
-    cfnresponse.send(event, context, cfnresponse.FAILED, {}, None)
-
-
 def handler(event, context):
-    # make sure we send a failure to CloudFormation if the function is going to timeout
-    timer = threading.Timer((context.get_remaining_time_in_millis() / 1000.00) - 0.5, timeout, args=[event, context])
-    timer.start()
-    print('Received event: ' + json.dumps(event))
-    status = cfnresponse.FAILED
-    new_physical_id = None
-    returnAttribute = {}
-    try:
-        properties = event.get('ResourceProperties')
-        physical_id = event.get('PhysicalResourceId')
-        status, new_physical_id, returnAttribute = {
-            'Create': create,
-            'Update': update,
-            'Delete': delete
-        }.get(event['RequestType'], lambda x, y: (cfnresponse.FAILED, None))(properties, physical_id)
-    except Exception as e:
-        print('Exception: ' + str(e))
-        status = cfnresponse.FAILED
-    finally:
-        timer.cancel()
-        cfnresponse.send(event, context, status, returnAttribute, new_physical_id)
+    cfnruntime.handle(event, context, {
+        'Create': create,
+        'Update': update,
+        'Delete': delete
+    })
@@ -0,0 +1,298 @@
+import queue
+import random
+import threading
+import time
+import cfnruntime
+
+# DeleteObjects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+MAX_DELETE_WORKERS = 32
+MIN_DELETE_WORKERS = 2
+# Batches listed ahead of the delete workers, bounds the memory used by the listing threads
+QUEUED_BATCHES = 64
+# Attempts of a batch, or of the keys of a batch, failing with a throttling or transient error
+MAX_DELETE_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 0.2
+BACKOFF_MAX_SECONDS = 10
+# Successful calls needed before the concurrency limit is raised again after backing off
+SUCCESSES_PER_WORKER_INCREASE = 8
+PROGRESS_INTERVAL_SECONDS = 30
+THROTTLING_ERRORS = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', '503')
+TRANSIENT_ERRORS = THROTTLING_ERRORS + ('InternalError', 'ServiceUnavailable', 'RequestTimeout')
+S3_CLIENT_CONFIG = {
+    'max_pool_connections': MAX_DELETE_WORKERS + 8,
+    'retries': {'max_attempts': 3, 'mode': 'standard'}
+}
+
+
+def get_s3_client():
+    return cfnruntime.get_client('s3', **S3_CLIENT_CONFIG)
+
+
+def get_backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class ConcurrencyLimiter:
+    """Additive increase, multiplicative decrease limit on the DeleteObjects calls in flight."""
+
+    def __init__(self, initial: int = MAX_DELETE_WORKERS // 2, minimum: int = MIN_DELETE_WORKERS,
+                 maximum: int = MAX_DELETE_WORKERS):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.successes = 0
+                if self.limit > self.minimum:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    print(f"S3 is throttling the deletes, lowering the concurrency to {self.limit}")
+            else:
+                self.successes += 1
+                if self.successes >= SUCCESSES_PER_WORKER_INCREASE * self.limit and self.limit < self.maximum:
+                    self.successes = 0
+                    self.limit += 1
+            self.condition.notify_all()
+
+
+class BucketProgress:
+    """Listing position of a bucket up to which every listed batch has been processed.
+
+    Batches complete out of order, so marker only moves past a page once all the batches before it
+    are done. Resuming from marker never skips an object that was not processed.
+    """
+
+    def __init__(self, marker: dict = None):
+        self.marker = marker
+        self.issued = 0
+        self.completed = 0
+        self.done = set()
+        self.page_markers = {}
+        self.listed = False
+
+    def issue(self, page_marker: dict = None) -> int:
+        sequence = self.issued
+        self.issued += 1
+        if page_marker:
+            self.page_markers[sequence] = page_marker
+        return sequence
+
+    def complete(self, sequence: int):
+        self.done.add(sequence)
+        while self.completed in self.done:
+            self.done.remove(self.completed)
+            if self.completed in self.page_markers:
+                self.marker = self.page_markers.pop(self.completed)
+            self.completed += 1
+
+    @property
+    def finished(self) -> bool:
+        return self.listed and self.completed == self.issued
+
+
+class DeleteStats:
+    def __init__(self, deleted: dict = None, failed: dict = None):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_report = self.started
+        # counts carried over from the previous runs of a resumed delete
+        self.deleted = dict(deleted or {})
+        self.failed = dict(failed or {})
+        self.initially_deleted = sum(self.deleted.values())
+        self.errors = []
+        self.progress = {}
+
+    def add(self, bucket: str, sequence: int, deleted: int, failed: list):
+        with self.lock:
+            self.progress[bucket].complete(sequence)
+            self.deleted[bucket] = self.deleted.get(bucket, 0) + deleted
+            self.failed[bucket] = self.failed.get(bucket, 0) + len(failed)
+            # keep a sample of the errors for the logs
+            self.errors.extend(failed[:max(0, 10 - len(self.errors))])
+            now = time.monotonic()
+            if now - self.last_report >= PROGRESS_INTERVAL_SECONDS:
+                self.last_report = now
+                print(f"Deleted {self.total_deleted()} objects at {self.rate()} objects/s")
+
+    def total_deleted(self) -> int:
+        return sum(self.deleted.values())
+
+    def total_failed(self) -> int:
+        return sum(self.failed.values())
+
+    def rate(self) -> float:
+        return round((self.total_deleted() - self.initially_deleted) / max(time.monotonic() - self.started, 0.001), 1)
+
+    @property
+    def finished(self) -> bool:
+        return all(progress.finished for progress in self.progress.values())
+
+    def get_checkpoint(self) -> dict:
+        """Listing marker of every bucket not emptied yet, None when nothing of it was processed."""
+        with self.lock:
+            return {bucket: progress.marker for bucket, progress in self.progress.items() if not progress.finished}
+
+
+def list_delete_batches(s3, bucket: str, marker: dict = None, last_key: str = None):
+    """Versions and delete markers of bucket, in lists of at most DELETE_BATCH_SIZE DeleteObjects entries.
+
+    Listing starts after marker, a KeyMarker/VersionIdMarker dict, and stops after last_key when
+    given. The last batch of every page comes with the marker resuming the listing after that page,
+    the other batches with None.
+    """
+    paginator = s3.get_paginator('list_object_versions')
+    for page in paginator.paginate(Bucket=bucket, **(marker or {}), PaginationConfig={'PageSize': DELETE_BATCH_SIZE}):
+        entries = [
+            {'Key': entry['Key'], 'VersionId': entry['VersionId']}
+            for entry in page.get('Versions', []) + page.get('DeleteMarkers', [])
+        ]
+        page_marker = None
+        if page.get('IsTruncated'):
+            page_marker = {'KeyMarker': page['NextKeyMarker'], 'VersionIdMarker': page['NextVersionIdMarker']}
+        # pages cover contiguous key ranges, nothing after a page reaching past last_key is wanted
+        if last_key is not None and any(entry['Key'] > last_key for entry in entries):
+            entries = [entry for entry in entries if entry['Key'] <= last_key]
+            page_marker = None
+        for start in range(0, len(entries), DELETE_BATCH_SIZE):
+            is_last = start + DELETE_BATCH_SIZE >= len(entries)
+            yield entries[start:start + DELETE_BATCH_SIZE], page_marker if is_last else None
+        if page_marker is None:
+            return
+
+
+def delete_batch(s3, limiter: ConcurrencyLimiter, bucket: str, objects: list, stop_at: float = None):
+    """Delete objects from bucket, retrying throttled and transient failures.
+
+    Returns the number of deleted objects and the per-key errors that could not be recovered, or
+    None when stop_at, a time.monotonic() value, passed before all the retries were done.
+    """
+    deleted = 0
+    failed = []
+    for attempt in range(MAX_DELETE_ATTEMPTS):
+        if attempt and stop_at is not None and time.monotonic() >= stop_at:
+            return None
+        if attempt:
+            time.sleep(get_backoff(attempt))
+        limiter.acquire()
+        try:
+            response = s3.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+        except Exception as e:
+            code = cfnruntime.get_error_code(e)
+            limiter.release(throttled=code in THROTTLING_ERRORS)
+            if code is None:
+                raise
+            if code not in TRANSIENT_ERRORS:
+                return deleted, failed + [dict(entry, Code=code, Message=str(e)) for entry in objects]
+            retry = [dict(entry, Code=code) for entry in objects]
+        else:
+            errors = response.get('Errors', [])
+            limiter.release(throttled=any(error.get('Code') in THROTTLING_ERRORS for error in errors))
+            deleted += len(objects) - len(errors)
+            failed.extend(error for error in errors if error.get('Code') not in TRANSIENT_ERRORS)
+            retry = [error for error in errors if error.get('Code') in TRANSIENT_ERRORS]
+        if not retry:
+            return deleted, failed
+        objects = [{'Key': entry['Key'], 'VersionId': entry['VersionId']} for entry in retry]
+    return deleted, failed + retry
+
+
+def empty_buckets(bucket_names: list, s3=None, max_workers: int = MAX_DELETE_WORKERS, markers: dict = None,
+                  stats: DeleteStats = None, stop_at: float = None, last_keys: dict = None,
+                  batch_sources: dict = None) -> DeleteStats:
+    """Delete every version and delete marker of bucket_names.
+
+    One thread per bucket lists versions into a bounded queue that a pool of workers drains with
+    DeleteObjects calls, so all the buckets are emptied at once. The number of calls in flight
+    adapts to S3 throttling. Keys that cannot be deleted are counted and logged, the remaining ones
+    are still deleted; the caller decides what to do with the failures in the returned stats.
+
+    Listing resumes from markers, as returned by DeleteStats.get_checkpoint(), and stops after the
+    key given for the bucket in last_keys, if any. batch_sources maps buckets to functions called with
+    the marker and returning (objects, marker) batches like list_delete_batches, which are deleted
+    instead of listing the bucket. Once stop_at, a
+    time.monotonic() value, has passed no new batch is started; the returned stats then are not
+    finished and their checkpoint resumes the work.
+    """
+    s3 = s3 or get_s3_client()
+    stats = stats or DeleteStats()
+    markers = markers or {}
+    last_keys = last_keys or {}
+    batch_sources = batch_sources or {}
+    limiter = ConcurrencyLimiter(initial=max(MIN_DELETE_WORKERS, max_workers // 2), maximum=max_workers)
+    batches = queue.Queue(maxsize=QUEUED_BATCHES)
+    listing_errors = []
+    for bucket in bucket_names:
+        stats.progress[bucket] = BucketProgress(markers.get(bucket))
+
+    def is_stopped() -> bool:
+        return stop_at is not None and time.monotonic() >= stop_at
+
+    def list_bucket(bucket: str):
+        progress = stats.progress[bucket]
+        try:
+            if bucket in batch_sources:
+                bucket_batches = batch_sources[bucket](progress.marker)
+            else:
+                bucket_batches = list_delete_batches(s3, bucket, progress.marker, last_keys.get(bucket))
+            for objects, page_marker in bucket_batches:
+                with stats.lock:
+                    sequence = progress.issue(page_marker)
+                batches.put((bucket, sequence, objects))
+                if is_stopped():
+                    return
+            progress.listed = True
+        except Exception as e:
+            if cfnruntime.get_error_code(e) == 'NoSuchBucket':
+                print(f"Bucket {bucket} does not exist anymore")
+                progress.listed = True
+                return
+            listing_errors.append(f"{bucket}: {e}")
+
+    def delete_worker():
+        while True:
+            item = batches.get()
+            if item is None:
+                return
+            bucket, sequence, objects = item
+            # batches left over at the deadline stay after the checkpoint
+            if is_stopped():
+                continue
+            try:
+                result = delete_batch(s3, limiter, bucket, objects, stop_at)
+            except Exception as e:
+                result = 0, [dict(entry, Code='Exception', Message=str(e)) for entry in objects]
+            if result is not None:
+                stats.add(bucket, sequence, *result)
+
+    listers = [threading.Thread(target=list_bucket, args=(bucket,), daemon=True) for bucket in bucket_names]
+    workers = [threading.Thread(target=delete_worker, daemon=True) for _ in range(max_workers)]
+    for thread in listers + workers:
+        thread.start()
+    for thread in listers:
+        thread.join()
+    for _ in workers:
+        batches.put(None)
+    for thread in workers:
+        thread.join()
+
+    for bucket in bucket_names:
+        state = 'emptied' if stats.progress[bucket].finished else 'not emptied yet'
+        print(f"Bucket {bucket} {state}: {stats.deleted.get(bucket, 0)} objects deleted, {stats.failed.get(bucket, 0)} failed")
+    print(f"Deleted {stats.total_deleted() - stats.initially_deleted} objects at {stats.rate()} objects/s")
+    if stats.errors:
+        print(f"Sample of the delete errors: {stats.errors}")
+    if listing_errors:
+        raise Exception(f"Failed to list objects of {listing_errors}")
+    return stats
@@ -0,0 +1,125 @@
+"""Delete batches read from S3 Inventory reports instead of listing the buckets.
+
+The manifests of a bucket are looked up under <destination>/<bucket>/, where S3 writes the
+reports of every inventory configuration of the bucket. CSV reports are streamed straight from S3
+row by row; Parquet reports are read one row group at a time and need pyarrow, which the Lambda
+runtime does not ship. A bucket without a readable report listing all the object versions is
+listed instead.
+"""
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import os
+import tempfile
+from urllib.parse import unquote_plus, urlparse
+from bucket_emptier import DELETE_BATCH_SIZE
+
+SUPPORTED_FORMATS = ('CSV', 'Parquet')
+PARQUET_COLUMNS = {'Key': 'key', 'VersionId': 'version_id'}
+
+
+def parse_s3_uri(uri: str):
+    parsed = urlparse(uri)
+    if parsed.scheme != 's3' or not parsed.netloc:
+        raise Exception(f"Invalid S3 location {uri}, expected s3://bucket/prefix")
+    return parsed.netloc, parsed.path.strip('/')
+
+
+def find_usable_manifest(s3, destination: str, bucket: str):
+    """(bucket, key) of the manifest of bucket under destination the delete can use, None when there is none.
+
+    The latest manifest of every inventory configuration of bucket is considered, newest first, so a
+    configuration including the object versions wins over a newer one that does not.
+    """
+    destination_bucket, prefix = parse_s3_uri(destination)
+    bucket_prefix = f"{prefix}/{bucket}/" if prefix else f"{bucket}/"
+    latest = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=destination_bucket, Prefix=bucket_prefix):
+        for entry in page.get('Contents', []):
+            # <config id>/<YYYY-MM-DDTHH-MMZ>/manifest.json, the date folders sort chronologically
+            parts = entry['Key'][len(bucket_prefix):].split('/')
+            if len(parts) == 3 and parts[2] == 'manifest.json' and parts[1] > latest.get(parts[0], ('',))[0]:
+                latest[parts[0]] = (parts[1], entry['Key'])
+    for _, manifest_key in sorted(latest.values(), reverse=True):
+        reason = get_unusable_reason(load_manifest(s3, destination_bucket, manifest_key))
+        if reason is None:
+            return destination_bucket, manifest_key
+        print(f"Skipping inventory manifest s3://{destination_bucket}/{manifest_key}: {reason}")
+    return None
+
+
+def load_manifest(s3, destination_bucket: str, manifest_key: str) -> dict:
+    manifest = json.loads(s3.get_object(Bucket=destination_bucket, Key=manifest_key)['Body'].read())
+    manifest['destinationBucketName'] = destination_bucket
+    return manifest
+
+
+def get_unusable_reason(manifest: dict):
+    """Why the delete cannot use manifest, None when its reports are readable and list all the object versions."""
+    if manifest['fileFormat'] not in SUPPORTED_FORMATS:
+        return f"{manifest['fileFormat']} reports are not supported"
+    if manifest['fileFormat'] == 'Parquet' and importlib.util.find_spec('pyarrow') is None:
+        return "Parquet reports need pyarrow, which is not installed"
+    if not has_versions(manifest):
+        return "the reports do not include the object versions"
+    return None
+
+
+def has_versions(manifest: dict) -> bool:
+    if manifest['fileFormat'] == 'CSV':
+        return 'VersionId' in [column.strip() for column in manifest['fileSchema'].split(',')]
+    return 'version_id' in manifest['fileSchema']
+
+
+def iter_csv_rows(s3, manifest: dict, file_key: str):
+    columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+    key_column = columns.index('Key')
+    version_column = columns.index('VersionId')
+    body = s3.get_object(Bucket=manifest['destinationBucketName'], Key=file_key)['Body']
+    with gzip.GzipFile(fileobj=body) as report:
+        for row in csv.reader(io.TextIOWrapper(report, encoding='utf-8', newline='')):
+            # object keys are URL encoded in CSV reports
+            yield unquote_plus(row[key_column]), row[version_column]
+
+
+def iter_parquet_rows(s3, manifest: dict, file_key: str):
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Reading Parquet inventory reports needs pyarrow installed")
+    with tempfile.TemporaryDirectory() as download_dir:
+        path = os.path.join(download_dir, 'report.parquet')
+        s3.download_file(manifest['destinationBucketName'], file_key, path)
+        report = pyarrow.parquet.ParquetFile(path)
+        for record_batch in report.iter_batches(batch_size=DELETE_BATCH_SIZE, columns=list(PARQUET_COLUMNS.values())):
+            columns = record_batch.to_pydict()
+            yield from zip(columns[PARQUET_COLUMNS['Key']], columns[PARQUET_COLUMNS['VersionId']])
+
+
+def inventory_delete_batches(s3, manifest: dict, marker: dict = None):
+    """DeleteObjects batches of the versions listed in manifest, resuming after marker.
+
+    Every batch comes with the marker of the report file and row following it, so a resumed run
+    only skips over the rows of the file it stopped in.
+    """
+    marker = marker or {'File': 0, 'Row': 0}
+    iter_rows = iter_csv_rows if manifest['fileFormat'] == 'CSV' else iter_parquet_rows
+    files = manifest['files']
+    for file_index in range(marker['File'], len(files)):
+        skip_rows = marker['Row'] if file_index == marker['File'] else 0
+        batch = []
+        row_index = 0
+        for row_index, (key, version_id) in enumerate(iter_rows(s3, manifest, files[file_index]['key']), 1):
+            if row_index <= skip_rows:
+                continue
+            # versions written before versioning was enabled have no id in the reports
+            batch.append({'Key': key, 'VersionId': version_id or 'null'})
+            if len(batch) == DELETE_BATCH_SIZE:
+                yield batch, {'File': file_index, 'Row': row_index}
+                batch = []
+        if batch:
+            yield batch, {'File': file_index, 'Row': row_index}
+        print(f"Inventory report {files[file_index]['key']} done, {row_index} rows")
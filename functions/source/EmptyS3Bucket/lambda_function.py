@@ -1,7 +1,41 @@
-import boto3
+import cfnruntime
+import awsmetrics
+import functools
 import json
 import cfnresponse
-import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from bucket_emptier import DeleteStats, empty_buckets, get_s3_client
+from inventory import find_usable_manifest, inventory_delete_batches, load_manifest
+from lifecycle import TAIL_OBJECTS, delete_empty_bucket, put_expire_all_rules, sample_object_count
+from sharding import SHARD_KEY, LambdaWorkerPool, empty_buckets_sharded, run_shard
+
+# Status of a delete handed over to the next invocation, which sends the response
+CONTINUE = 'CONTINUE'
+# Status of a delete answered to CloudFormation right away and finished by later scheduled invocations
+HAND_OFF = 'HAND_OFF'
+CHECKPOINT_KEY = 'EmptyS3BucketCheckpoint'
+# Time kept at the end of an invocation to finish the deletes in flight and hand over to the next one
+CHECKPOINT_MARGIN_SECONDS = 60
+# CloudFormation waits an hour for the response of a custom resource
+RESPONSE_WINDOW_SECONDS = 3600
+# Time between two samples of the buckets emptied by their lifecycle rules, every sample is a
+# separate invocation started by a one-time EventBridge Scheduler schedule
+LIFECYCLE_POLL_SECONDS = 3600
+# S3 usually applies new lifecycle rules within two days, the buckets are given up on after a week
+LIFECYCLE_MAX_WAIT_SECONDS = 7 * 24 * 3600
+# The function role may only create the schedules with this name prefix
+SCHEDULE_NAME_PREFIX = 'EmptyS3Bucket-'
+# Inline policy of the function role allowing the removal of the retained resources, deleted last
+LIFECYCLE_POLICY_NAME = 'LifecycleCleanupAllow'
+# Metric counting the lifecycle cleanups given up on, which leave resources to delete manually
+ABANDONED_CLEANUP_METRIC = 'AbandonedLifecycleCleanups'
+# parallel: this function lists and deletes everything, sharded: it splits the buckets and
+# coordinates one worker invocation per key range, inventory: it deletes the versions in the latest
+# S3 Inventory reports of the buckets, then lists them for what was written since, lifecycle: it sets
+# rules expiring everything, answers CloudFormation and deletes the buckets once S3 expired their objects
+DELETE_MODES = ('parallel', 'sharded', 'inventory', 'lifecycle')
 
 
 def create(properties, physical_id):
@@ -18,42 +52,240 @@ def update(properties, physical_id):
     return cfnresponse.SUCCESS, physical_id, return_attribute
 
 
-def delete(properties, physical_id):
-    bucket_names = properties['BucketNames']
-    print(f'Deleting objects in buckets: {bucket_names} ...')
-    print(properties)
-    s3 = boto3.resource('s3')
-    for bucket_name in bucket_names:
-        bucket = s3.Bucket(bucket_name)
-        bucket.object_versions.delete()
-        print(f'Bucket {bucket_name} emptied.')
+def get_delete_result(checkpoint: dict, finished: bool, unfinished_work: dict, deleted: dict, failed: dict,
+                      errors: list, physical_id):
+    """Response of a delete run: CONTINUE with the next checkpoint while work is left, SUCCESS once done."""
+    if not finished:
+        if time.time() - checkpoint['StartedAt'] + CHECKPOINT_MARGIN_SECONDS >= RESPONSE_WINDOW_SECONDS:
+            raise Exception(f'Buckets not emptied within the CloudFormation response window: {unfinished_work}')
+        return CONTINUE, physical_id, dict(checkpoint, Invocation=checkpoint['Invocation'] + 1,
+                                           Deleted=deleted, Failed=failed, **unfinished_work)
+    total_failed = sum(failed.values())
+    if total_failed:
+        raise Exception(f'Failed to delete {total_failed} objects, sample of the errors: {errors}')
     return_attribute = dict(Action='DELETE')
     return cfnresponse.SUCCESS, physical_id, return_attribute
 
 
-def timeout(event, context):
-    print('Execution is about to time out, sending failure response to CloudFormation')
-    cfnresponse.send(event, context, cfnresponse.FAILED, {}, None)
+def delete_from_inventory(properties, checkpoint: dict, stop_at: float) -> DeleteStats:
+    """Inventory phase of a delete, limited to the buckets with a usable report; updates checkpoint."""
+    s3 = get_s3_client()
+    if checkpoint['Manifests'] is None:
+        checkpoint['Manifests'] = {}
+        if not properties.get('InventoryDestination'):
+            print('No inventory destination given, the buckets are only listed')
+        for bucket in properties['BucketNames'] if properties.get('InventoryDestination') else []:
+            location = find_usable_manifest(s3, properties['InventoryDestination'], bucket)
+            if location is None:
+                print(f'No usable inventory report for {bucket}, it is only listed')
+                continue
+            print(f'Using inventory manifest s3://{location[0]}/{location[1]} for {bucket}')
+            checkpoint['Manifests'][bucket] = location
+        checkpoint['Markers'] = {bucket: None for bucket in checkpoint['Manifests']}
+
+    batch_sources = {
+        bucket: functools.partial(inventory_delete_batches, s3, load_manifest(s3, *checkpoint['Manifests'][bucket]))
+        for bucket in checkpoint['Markers']
+    }
+    return empty_buckets(list(batch_sources), markers=checkpoint['Markers'],
+                         stats=DeleteStats(checkpoint['Deleted'], checkpoint['Failed']), stop_at=stop_at,
+                         batch_sources=batch_sources)
+
+
+def delete_role(iam, role_name: str, last_policy: str = None):
+    """Delete the inline policies of role_name, last_policy last, then the role unless last_policy is given.
+
+    A role cannot delete itself: the permission to do so would be gone with its last policy.
+    """
+    policy_names = iam.list_role_policies(RoleName=role_name)['PolicyNames']
+    for policy_name in sorted(policy_names, key=lambda name: name == last_policy):
+        iam.delete_role_policy(RoleName=role_name, PolicyName=policy_name)
+    if last_policy is None:
+        iam.delete_role(RoleName=role_name)
+
+
+def delete_retained_resources(properties, function_arn: str):
+    """Remove what CloudFormation retained for the lifecycle mode once the buckets are deleted.
+
+    The scheduler role and this function are deleted, the function role loses its policies and is
+    left empty, to be deleted manually.
+    """
+    iam = cfnruntime.get_client('iam')
+    delete_role(iam, properties['SchedulerRoleName'])
+    print(f"Deleted the scheduler role {properties['SchedulerRoleName']}")
+    # the running invocation goes on after its function is deleted
+    cfnruntime.get_client('lambda').delete_function(FunctionName=function_arn)
+    print(f'Deleted the cleanup function {function_arn}')
+    delete_role(iam, properties['CleanupRoleName'], last_policy=LIFECYCLE_POLICY_NAME)
+    print(f"Removed the policies of the cleanup function role {properties['CleanupRoleName']}, "
+          f"the role is left without permissions and can be deleted")
+
+
+def report_abandoned_cleanup(properties, remaining: list, function_arn: str):
+    """Log what a lifecycle cleanup giving up leaves behind, with a metric to alarm on."""
+    leftovers = {
+        'Buckets': remaining,
+        'CleanupFunction': function_arn,
+        'CleanupRole': properties['CleanupRoleName'],
+        'SchedulerRole': properties['SchedulerRoleName']
+    }
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': awsmetrics.NAMESPACE,
+                'Dimensions': [[]],
+                'Metrics': [{'Name': ABANDONED_CLEANUP_METRIC, 'Unit': 'Count'}]
+            }]
+        },
+        ABANDONED_CLEANUP_METRIC: 1,
+        **leftovers
+    }))
+    return leftovers
+
+
+def delete_with_lifecycle(properties, checkpoint: dict, stop_at: float, physical_id, function_arn: str):
+    """Lifecycle mode delete: set the rules and hand off, then check the buckets on every scheduled invocation."""
+    s3 = get_s3_client()
+    if checkpoint['Phase'] == 'lifecycle':
+        for bucket in properties['BucketNames']:
+            if put_expire_all_rules(s3, bucket):
+                print(f'Lifecycle expiration of all objects set on {bucket}')
+        return HAND_OFF, physical_id, dict(checkpoint, Invocation=checkpoint['Invocation'] + 1, Phase='expiring',
+                                           ResponseSent=True)
+
+    remaining = list(checkpoint['Markers'])
+    deleted = checkpoint['Deleted']
+    counts = {bucket: sample_object_count(s3, bucket) for bucket in remaining}
+    print(f"Objects left: { {bucket: f'more than {TAIL_OBJECTS}' if count is None else count for bucket, count in counts.items()} }")
+    # the tail S3 has not expired yet is cheaper to delete than to wait for
+    tails = [bucket for bucket, count in counts.items() if count is not None]
+    if tails:
+        stats = empty_buckets(tails, stats=DeleteStats(deleted), stop_at=stop_at)
+        deleted = stats.deleted
+        for bucket in tails:
+            if stats.progress[bucket].finished and not stats.failed.get(bucket) and delete_empty_bucket(s3, bucket):
+                remaining.remove(bucket)
+
+    if not remaining:
+        print(f'All buckets deleted, {sum(deleted.values())} objects deleted besides the expired ones')
+        delete_retained_resources(properties, function_arn)
+        return cfnresponse.SUCCESS, physical_id, dict(Action='DELETE')
+    if time.time() - checkpoint['StartedAt'] >= LIFECYCLE_MAX_WAIT_SECONDS:
+        leftovers = report_abandoned_cleanup(properties, remaining, function_arn)
+        raise Exception(f'Buckets not emptied by their lifecycle rules in time, giving up, delete these resources '
+                        f'manually: {leftovers}')
+    return HAND_OFF, physical_id, dict(checkpoint, Invocation=checkpoint['Invocation'] + 1,
+                                       Markers={bucket: None for bucket in remaining}, Deleted=deleted)
+
+
+def delete(properties, physical_id, checkpoint=None, stop_at=None, function_name=None):
+    mode = properties.get('DeleteMode') or 'parallel'
+    if mode not in DELETE_MODES:
+        raise Exception(f'Unknown delete mode {mode}')
+    if checkpoint is None:
+        checkpoint = {
+            'StartedAt': time.time(),
+            'Invocation': 0,
+            'Phase': mode if mode in ('inventory', 'lifecycle') else 'listing',
+            'Markers': {bucket: None for bucket in properties['BucketNames']},
+            'Shards': None,
+            'Manifests': None,
+            'Deleted': {},
+            'Failed': {}
+        }
+    else:
+        print(f"Resuming invocation {checkpoint['Invocation']} from {checkpoint['Markers'] or checkpoint['Shards']}")
+    print(f"Deleting objects in buckets: {properties['BucketNames']} ...")
+
+    if mode == 'sharded':
+        pool = LambdaWorkerPool(function_name)
+        try:
+            result = empty_buckets_sharded(properties['BucketNames'], pool, time.time() + stop_at - time.monotonic(),
+                                           checkpoint['Shards'])
+        finally:
+            pool.shutdown()
+        deleted = {bucket: checkpoint['Deleted'].get(bucket, 0) + result['Deleted'].get(bucket, 0)
+                   for bucket in set(checkpoint['Deleted']) | set(result['Deleted'])}
+        failed = {bucket: checkpoint['Failed'].get(bucket, 0) + result['Failed'].get(bucket, 0)
+                  for bucket in set(checkpoint['Failed']) | set(result['Failed'])}
+        return get_delete_result(checkpoint, not result['Shards'], {'Shards': result['Shards']}, deleted, failed,
+                                 result['Errors'], physical_id)
+
+    if mode == 'lifecycle':
+        return delete_with_lifecycle(properties, checkpoint, stop_at, physical_id, function_name)
+
+    if checkpoint['Phase'] == 'inventory':
+        stats = delete_from_inventory(properties, checkpoint, stop_at)
+        if not stats.finished:
+            return get_delete_result(checkpoint, False, {'Markers': stats.get_checkpoint()}, stats.deleted,
+                                     stats.failed, stats.errors, physical_id)
+        # a last listing pass catches the objects written after the reports
+        print('Inventory reports done, listing the buckets for newer objects')
+        checkpoint = dict(checkpoint, Phase='listing', Markers={bucket: None for bucket in properties['BucketNames']},
+                          Deleted=stats.deleted, Failed=stats.failed)
+
+    stats = empty_buckets(list(checkpoint['Markers']), markers=checkpoint['Markers'],
+                          stats=DeleteStats(checkpoint['Deleted'], checkpoint['Failed']), stop_at=stop_at)
+    return get_delete_result(checkpoint, stats.finished, {'Markers': stats.get_checkpoint()}, stats.deleted,
+                             stats.failed, stats.errors, physical_id)
+
+
+def continue_asynchronously(event, context, checkpoint):
+    print(f"Continuing in invocation {checkpoint['Invocation']} from {checkpoint['Markers'] or checkpoint['Shards']}")
+    cfnruntime.get_client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(dict(event, **{CHECKPOINT_KEY: checkpoint})).encode('utf-8')
+    )
+
+
+def schedule_next_invocation(event, context, properties, checkpoint):
+    """Invoke this function again with checkpoint in LIFECYCLE_POLL_SECONDS, through a schedule deleted once done."""
+    run_at = datetime.fromtimestamp(time.time() + LIFECYCLE_POLL_SECONDS, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    cfnruntime.get_client('scheduler').create_schedule(
+        Name=f'{SCHEDULE_NAME_PREFIX}{uuid.uuid4().hex}',
+        ScheduleExpression=f'at({run_at})',
+        ScheduleExpressionTimezone='UTC',
+        FlexibleTimeWindow={'Mode': 'OFF'},
+        ActionAfterCompletion='DELETE',
+        Target={
+            'Arn': context.invoked_function_arn,
+            'RoleArn': properties['SchedulerRoleArn'],
+            'Input': json.dumps(dict(event, **{CHECKPOINT_KEY: checkpoint}))
+        }
+    )
+    print(f"Invocation {checkpoint['Invocation']} scheduled at {run_at} UTC")
+
+
+def delete_and_continue(event, context, properties, physical_id, stop_at):
+    """Delete request, handing the work left over to the next invocation."""
+    status, new_physical_id, return_attribute = delete(properties, physical_id, event.get(CHECKPOINT_KEY), stop_at,
+                                                       context.invoked_function_arn)
+    if status == CONTINUE:
+        continue_asynchronously(event, context, return_attribute)
+        return cfnruntime.DEFERRED, new_physical_id, {}
+    if status == HAND_OFF:
+        schedule_next_invocation(event, context, properties, return_attribute)
+        return cfnresponse.SUCCESS, new_physical_id, dict(Action='DELETE')
+    return status, new_physical_id, return_attribute
 
 
 def handler(event, context):
-    # make sure we send a failure to CloudFormation if the function is going to timeout
-    timer = threading.Timer((context.get_remaining_time_in_millis() / 1000.00) - 0.5, timeout, args=[event, context])
-    timer.start()
-    print('Received event: ' + json.dumps(event))
-    status = cfnresponse.FAILED
-    new_physical_id = None
-    return_attribute = {}
-    try:
-        properties = event.get('ResourceProperties')
-        physical_id = event.get('PhysicalResourceId')
-        status, new_physical_id, return_attribute = {
-            'Create': create,
-            'Update': update,
-            'Delete': delete
-        }.get(event['RequestType'], lambda x, y: (cfnresponse.FAILED, None))(properties, physical_id)
-    except Exception as e:
-        print('Exception: ' + str(e))
-        status = cfnresponse.FAILED
-    finally:
-        cfnresponse.send(event, context, status, return_attribute, new_physical_id)
\ No newline at end of file
+    if SHARD_KEY in event:
+        # worker invocation of a sharded delete, answering its coordinator rather than CloudFormation
+        cfnruntime.log_invocation_start()
+        print('Received shard: ' + json.dumps(event[SHARD_KEY]))
+        try:
+            return run_shard(event[SHARD_KEY])
+        finally:
+            awsmetrics.flush()
+    # after a hand off CloudFormation already has its response, the next invocations only log their outcome
+    responded = event.get(CHECKPOINT_KEY, {}).get('ResponseSent', False)
+    # long deletes checkpoint before the timeout and go on in a new invocation
+    stop_at = time.monotonic() + context.get_remaining_time_in_millis() / 1000.00 - CHECKPOINT_MARGIN_SECONDS
+    cfnruntime.handle(event, context, {
+        'Create': create,
+        'Update': update,
+        'Delete': lambda properties, physical_id: delete_and_continue(event, context, properties, physical_id, stop_at)
+    }, respond=not responded)
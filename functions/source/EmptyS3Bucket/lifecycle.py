@@ -0,0 +1,88 @@
+"""Emptying buckets through lifecycle expiration, the deletes being done by S3 at no request charge.
+
+S3 applies lifecycle rules asynchronously, usually within a day or two after they are set, much
+longer than CloudFormation waits for a custom resource. The rules are installed while the stack
+is deleted, then later invocations sample how much is left and delete the remaining tail and the
+buckets themselves, which CloudFormation retains in this mode.
+"""
+import cfnruntime
+
+# Expiration by age and of expired delete markers cannot share a rule
+EXPIRE_ALL_RULES = [
+    {
+        'ID': 'ExpireAllObjects',
+        'Filter': {'Prefix': ''},
+        'Status': 'Enabled',
+        'Expiration': {'Days': 1},
+        'NoncurrentVersionExpiration': {'NoncurrentDays': 1},
+        'AbortIncompleteMultipartUpload': {'DaysAfterInitiation': 1}
+    },
+    {
+        'ID': 'ExpireDeleteMarkers',
+        'Filter': {'Prefix': ''},
+        'Status': 'Enabled',
+        'Expiration': {'ExpiredObjectDeleteMarker': True}
+    }
+]
+# Buckets with at most this many versions and delete markers left are emptied with DeleteObjects
+TAIL_OBJECTS = 10000
+SAMPLE_PAGE_SIZE = 1000
+
+
+def put_expire_all_rules(s3, bucket: str) -> bool:
+    """Replace the lifecycle configuration of bucket with EXPIRE_ALL_RULES, False when it does not exist."""
+    try:
+        s3.put_bucket_lifecycle_configuration(Bucket=bucket, LifecycleConfiguration={'Rules': EXPIRE_ALL_RULES})
+    except Exception as e:
+        if cfnruntime.get_error_code(e) == 'NoSuchBucket':
+            return False
+        raise
+    return True
+
+
+def sample_object_count(s3, bucket: str, limit: int = TAIL_OBJECTS):
+    """Versions and delete markers left in bucket, None when there are more than limit.
+
+    Only the first pages of the listing are read, so a large bucket costs a handful of calls.
+    A bucket that does not exist anymore counts as empty.
+    """
+    count = 0
+    paginator = s3.get_paginator('list_object_versions')
+    try:
+        for page in paginator.paginate(Bucket=bucket, PaginationConfig={'PageSize': SAMPLE_PAGE_SIZE}):
+            count += len(page.get('Versions', [])) + len(page.get('DeleteMarkers', []))
+            if count > limit:
+                return None
+    except Exception as e:
+        if cfnruntime.get_error_code(e) == 'NoSuchBucket':
+            return 0
+        raise
+    return count
+
+
+def abort_incomplete_uploads(s3, bucket: str) -> int:
+    aborted = 0
+    paginator = s3.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket):
+        for upload in page.get('Uploads', []):
+            s3.abort_multipart_upload(Bucket=bucket, Key=upload['Key'], UploadId=upload['UploadId'])
+            aborted += 1
+    return aborted
+
+
+def delete_empty_bucket(s3, bucket: str) -> bool:
+    """Delete bucket once it is empty, False when objects were written to it meanwhile."""
+    try:
+        aborted = abort_incomplete_uploads(s3, bucket)
+        if aborted:
+            print(f"Aborted {aborted} incomplete multipart uploads in {bucket}")
+        s3.delete_bucket(Bucket=bucket)
+    except Exception as e:
+        code = cfnruntime.get_error_code(e)
+        if code == 'NoSuchBucket':
+            return True
+        if code == 'BucketNotEmpty':
+            return False
+        raise
+    print(f"Bucket {bucket} deleted")
+    return True
@@ -0,0 +1,158 @@
+"""Fan-out of bucket emptying over independent workers, each deleting one key range shard of a bucket.
+
+A shard is a dict with the Bucket, the key range (After, Through], both ends None when open, the
+listing Marker to resume from and StopAt, the epoch time by which the worker has to hand back its
+result. Workers run run_shard, in a LambdaWorkerPool invoking this function once per shard.
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import cfnruntime
+from bucket_emptier import DeleteStats, empty_buckets, get_s3_client
+
+MAX_SHARDS_PER_BUCKET = 16
+MAX_SHARD_WORKERS = 32
+# Delete workers inside every shard worker, the shards already spread the load
+SHARD_DELETE_WORKERS = 8
+# Keys looked up to find split points in buckets without enough top level prefixes
+SAMPLE_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+MAX_PREFIX_DEPTH = 4
+# A shard round is only started with at least this much time left for it
+MIN_SHARD_SECONDS = 30
+# Workers stop this long before the coordinator, to return their results in time
+SHARD_RESULT_MARGIN_SECONDS = 10
+# Rounds in a row a shard worker may fail before the whole delete fails
+MAX_SHARD_ATTEMPTS = 3
+# Event key of the shard a worker invocation has to empty
+SHARD_KEY = 'EmptyS3BucketShard'
+# Synchronous invocations last as long as the worker, do not run them twice on a read timeout
+LAMBDA_CLIENT_CONFIG = {'read_timeout': 900, 'connect_timeout': 10, 'retries': {'total_max_attempts': 1}}
+
+
+def get_prefix_boundaries(s3, bucket: str, prefix: str = '', depth: int = 0) -> list:
+    """Common prefixes under prefix, descending while everything sits under a single one."""
+    page = s3.list_object_versions(Bucket=bucket, Prefix=prefix, Delimiter='/', MaxKeys=1000)
+    prefixes = [common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', [])]
+    has_objects = page.get('Versions') or page.get('DeleteMarkers')
+    if len(prefixes) == 1 and not has_objects and depth < MAX_PREFIX_DEPTH:
+        return get_prefix_boundaries(s3, bucket, prefixes[0], depth + 1)
+    return prefixes
+
+
+def sample_key_boundaries(s3, bucket: str) -> list:
+    """First keys after evenly spread one character markers, distinct and sorted."""
+    boundaries = set()
+    for character in SAMPLE_ALPHABET:
+        page = s3.list_object_versions(Bucket=bucket, KeyMarker=character, MaxKeys=1)
+        entries = page.get('Versions', []) + page.get('DeleteMarkers', [])
+        if entries:
+            boundaries.add(min(entry['Key'] for entry in entries))
+    return sorted(boundaries)
+
+
+def get_shards(s3, bucket: str, max_shards: int = MAX_SHARDS_PER_BUCKET) -> list:
+    """Split bucket into at most max_shards key ranges, on its common prefixes or on sampled keys.
+
+    A bucket that does not exist anymore has nothing left to delete and gets no shards.
+    """
+    try:
+        boundaries = get_prefix_boundaries(s3, bucket)
+    except Exception as e:
+        if cfnruntime.get_error_code(e) != 'NoSuchBucket':
+            raise e
+        print(f"Bucket {bucket} does not exist anymore")
+        return []
+    if len(boundaries) < max_shards:
+        boundaries = sorted(set(boundaries) | set(sample_key_boundaries(s3, bucket)))
+    if len(boundaries) >= max_shards:
+        boundaries = [boundaries[(position + 1) * len(boundaries) // max_shards - 1] for position in range(max_shards - 1)]
+    edges = [None] + boundaries + [None]
+    shards = [
+        {'Bucket': bucket, 'After': edges[position], 'Through': edges[position + 1], 'Marker': None}
+        for position in range(len(edges) - 1)
+    ]
+    print(f"Bucket {bucket} split into {len(shards)} shards at {boundaries}")
+    return shards
+
+
+def run_shard(shard: dict, s3=None) -> dict:
+    """Empty the key range of shard until it is done or its StopAt time has come."""
+    bucket = shard['Bucket']
+    marker = shard['Marker'] or ({'KeyMarker': shard['After']} if shard['After'] is not None else None)
+    stop_at = time.monotonic() + shard['StopAt'] - time.time()
+    stats = empty_buckets([bucket], s3=s3, max_workers=SHARD_DELETE_WORKERS, markers={bucket: marker},
+                          stats=DeleteStats(), stop_at=stop_at, last_keys={bucket: shard['Through']})
+    checkpoint = stats.get_checkpoint()
+    return {
+        'Shard': shard,
+        'Finished': stats.finished,
+        'Marker': checkpoint.get(bucket),
+        'Deleted': stats.total_deleted(),
+        'Failed': stats.total_failed(),
+        'Errors': stats.errors
+    }
+
+
+class LambdaWorkerPool:
+    """Shard workers in synchronous invocations of function_name, handled by its run_shard."""
+
+    def __init__(self, function_name: str, max_workers: int = MAX_SHARD_WORKERS):
+        self.function_name = function_name
+        self.lambda_client = cfnruntime.get_client('lambda', **LAMBDA_CLIENT_CONFIG)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def invoke(self, shard: dict) -> dict:
+        response = self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps({SHARD_KEY: shard}).encode('utf-8')
+        )
+        result = json.loads(response['Payload'].read())
+        if response.get('FunctionError'):
+            raise Exception(f"Shard worker failed: {result}")
+        return result
+
+    def submit(self, shard: dict):
+        return self.executor.submit(self.invoke, shard)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def empty_buckets_sharded(bucket_names: list, pool, stop_at: float, shards: list = None, s3=None) -> dict:
+    """Coordinate the workers of pool until every shard is empty or stop_at, an epoch time, comes.
+
+    Shards handed back unfinished are submitted again from their marker in the next round. Returns
+    the remaining shards and the per bucket counts; shards defaults to splitting bucket_names.
+    """
+    if shards is None:
+        s3 = s3 or get_s3_client()
+        shards = [shard for bucket in bucket_names for shard in get_shards(s3, bucket)]
+    deleted = {}
+    failed = {}
+    errors = []
+    started = time.monotonic()
+    while shards and stop_at - time.time() >= MIN_SHARD_SECONDS + SHARD_RESULT_MARGIN_SECONDS:
+        futures = {pool.submit(dict(shard, StopAt=stop_at - SHARD_RESULT_MARGIN_SECONDS)): shard for shard in shards}
+        shards = []
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                attempts = shard.get('Attempts', 0) + 1
+                if attempts >= MAX_SHARD_ATTEMPTS:
+                    raise Exception(f"Shard {shard} failed {attempts} times, last error: {e}")
+                print(f"Shard {shard} failed, trying again: {e}")
+                shards.append(dict(shard, Attempts=attempts))
+                continue
+            bucket = shard['Bucket']
+            deleted[bucket] = deleted.get(bucket, 0) + result['Deleted']
+            failed[bucket] = failed.get(bucket, 0) + result['Failed']
+            errors.extend(result['Errors'][:max(0, 10 - len(errors))])
+            if not result['Finished']:
+                shards.append(dict(shard, Marker=result['Marker'], Attempts=0))
+        print(f"Shard round done: {sum(deleted.values())} objects deleted at "
+              f"{round(sum(deleted.values()) / max(time.monotonic() - started, 0.001), 1)} objects/s, "
+              f"{len(shards)} shards left")
+    return {'Shards': shards, 'Deleted': deleted, 'Failed': failed, 'Errors': errors}
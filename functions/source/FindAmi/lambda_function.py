@@ -1,5 +1,4 @@
-import boto3
-import json
+import cfnruntime
 import cfnresponse
 
 
@@ -10,7 +9,7 @@ def create(properties, physical_id):
     virtualization_type = properties["VirtualizationType"]
     owners = properties["Owners"]
     image_id = ""
-    ec2 = boto3.client("ec2", region)
+    ec2 = cfnruntime.get_client("ec2", region)
     images = ec2.describe_images(
         ExecutableUsers=["all"],
         Filters=[
@@ -49,20 +48,8 @@ def delete(properties, physical_id):
 
 
 def handler(event, context):
-    print("Received event: " + json.dumps(event))
-    status = cfnresponse.FAILED
-    new_physical_id = None
-    return_attribute = {}
-    try:
-        properties = event.get("ResourceProperties")
-        physical_id = event.get("PhysicalResourceId")
-        status, new_physical_id, return_attribute = {
-            "Create": create,
-            "Update": update,
-            "Delete": delete
-        }.get(event["RequestType"], lambda x, y: (cfnresponse.FAILED, None))(properties, physical_id)
-    except Exception as e:
-        print("Exception: " + str(e))
-        status = cfnresponse.FAILED
-    finally:
-        cfnresponse.send(event, context, status, return_attribute, new_physical_id)
+    cfnruntime.handle(event, context, {
+        "Create": create,
+        "Update": update,
+        "Delete": delete
+    })
@@ -0,0 +1,111 @@
+"""Custom resource runtime shared by the functions, copied into every function folder like cfnresponse.
+
+handle() dispatches a CloudFormation request to the create/update/delete functions, sends a
+failure shortly before the function times out and sends the response exactly once. boto3 is only
+imported when the first client is needed and the clients are kept for the next invocations of a
+warm container, instrumented by awsmetrics, whose metrics are logged at the end of every
+invocation. Import this module first in lambda_function so the init timing covers the others.
+"""
+import json
+import threading
+import time
+import awsmetrics
+import cfnresponse
+
+_loaded_at = time.monotonic()
+_cold_start = True
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Status of a request answered by a later invocation, nothing is sent for it
+DEFERRED = 'DEFERRED'
+# The failure response is sent this long before the function times out
+TIMEOUT_MARGIN_SECONDS = 0.5
+
+
+def get_error_code(e: Exception) -> str:
+    """AWS error code of a botocore ClientError, None for any other exception, without importing botocore."""
+    response = getattr(e, 'response', None)
+    return response.get('Error', {}).get('Code') if isinstance(response, dict) else None
+
+
+def get_client(service: str, region: str = None, **config):
+    """boto3 client for service in region, created once per container; config holds botocore Config options."""
+    key = (service, region, json.dumps(config, sort_keys=True))
+    with _clients_lock:
+        if key not in _clients:
+            started = time.monotonic()
+            import boto3
+            from botocore.config import Config
+            _clients[key] = awsmetrics.instrument(
+                boto3.client(service, region_name=region, config=Config(**config) if config else None))
+            print(f"Created {service} client for {region or 'the default region'} in "
+                  f"{round((time.monotonic() - started) * 1000)} ms")
+        return _clients[key]
+
+
+class Response:
+    """The response of a request, only the first of the guard and the handler gets to send it."""
+
+    def __init__(self, event, context):
+        self.event = event
+        self.context = context
+        self.lock = threading.Lock()
+        self.sent = False
+
+    def send(self, status, data, physical_id=None):
+        with self.lock:
+            if self.sent:
+                return
+            self.sent = True
+        cfnresponse.send(self.event, self.context, status, data, physical_id)
+
+    def timeout(self):
+        print('Execution is about to time out, sending failure response to CloudFormation')
+        self.send(cfnresponse.FAILED, {})
+
+
+def log_invocation_start():
+    global _cold_start
+    if _cold_start:
+        _cold_start = False
+        print(f"Cold start, {round((time.monotonic() - _loaded_at) * 1000)} ms since the runtime was loaded")
+
+
+def handle(event, context, handlers: dict, respond: bool = True):
+    """Run handlers[RequestType](properties, physical_id) and send the (status, physical_id, data) it returns.
+
+    A DEFERRED status sends nothing, neither does respond=False, for invocations going on after the
+    response was sent. Exceptions are logged and answered with a failure.
+    """
+    started = time.monotonic()
+    log_invocation_start()
+    response = Response(event, context)
+    # make sure we send a failure to CloudFormation if the function is going to timeout
+    guard = threading.Timer(context.get_remaining_time_in_millis() / 1000.00 - TIMEOUT_MARGIN_SECONDS, response.timeout)
+    guard.daemon = True
+    if respond:
+        guard.start()
+    # the properties can be large and hold credentials, only their names are logged
+    print(f"Received {event.get('RequestType')} request for {event.get('LogicalResourceId')} with properties "
+          f"{sorted(event.get('ResourceProperties') or {})}")
+    status = cfnresponse.FAILED
+    new_physical_id = None
+    return_attribute = {}
+    try:
+        request_type = event['RequestType']
+        if request_type not in handlers:
+            raise Exception(f'Unknown request type {request_type}')
+        status, new_physical_id, return_attribute = handlers[request_type](
+            event.get('ResourceProperties'), event.get('PhysicalResourceId'))
+    except Exception as e:
+        print('Exception: ' + str(e))
+        status = cfnresponse.FAILED
+        return_attribute = {}
+    finally:
+        guard.cancel()
+        if respond and status != DEFERRED:
+            response.send(status, return_attribute, new_physical_id)
+        awsmetrics.flush()
+        print(f"Invocation done in {round((time.monotonic() - started) * 1000)} ms")
+    return status
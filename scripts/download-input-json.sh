@@ -0,0 +1,52 @@
+#!/bin/bash
+set -eu
+
+# Writes the input json file stored in a Secrets Manager secret to a file.
+# The secret holds either the plain json document or, with compressed storage, a manifest
+# with the gzip compressed document base64 encoded inline or split across part secrets.
+# usage: download-input-json.sh <secret id> <output file>
+
+function get_secret_string() {
+  /usr/local/bin/aws secretsmanager get-secret-value --secret-id "$1" | jq -r '.SecretString'
+}
+
+function main() {
+  local secret_id="$1"
+  local output="$2"
+  local secret_string
+  local manifest
+  local payload_file
+  local part
+
+  secret_string="$(get_secret_string "${secret_id}")"
+  manifest="$(jq -c '.uipath_input_json // empty' <<<"${secret_string}")"
+  if [[ -z "${manifest}" ]]; then
+    jq '.' <<<"${secret_string}" >"${output}"
+    return
+  fi
+
+  if [[ "$(jq -r '.encoding' <<<"${manifest}")" != "gzip+base64" ]]; then
+    echo "Unsupported input json encoding in ${secret_id}"
+    exit 1
+  fi
+
+  payload_file="$(mktemp)"
+  trap "rm -f '${payload_file}' '${payload_file}.gz'" EXIT
+  if [[ "$(jq -r 'has("parts")' <<<"${manifest}")" == "true" ]]; then
+    for part in $(jq -r '.parts[]' <<<"${manifest}"); do
+      echo "Downloading input json part ${part}"
+      get_secret_string "${part}" | tr -d '\n' >>"${payload_file}"
+    done
+  else
+    jq -r '.data' <<<"${manifest}" | tr -d '\n' >"${payload_file}"
+  fi
+
+  base64 -d "${payload_file}" >"${payload_file}.gz"
+  if [[ "$(sha256sum "${payload_file}.gz" | cut -d ' ' -f 1)" != "$(jq -r '.sha256' <<<"${manifest}")" ]]; then
+    echo "Checksum mismatch for the input json stored in ${secret_id}"
+    exit 1
+  fi
+  gunzip -c "${payload_file}.gz" | jq '.' >"${output}"
+}
+
+main "$@"